@@ -0,0 +1,92 @@
+"""图片解码准入控制
+
+解码前根据文件头估算所需内存，所有正在进行的解码共享一个进程级的内存预算，
+超出预算的请求排队等待，等待超时或单张图片本身超出预算时拒绝。
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from PIL import Image
+
+from metrics_utils import Gauge, Counter, queue_depth
+
+# 进程内同时解码可使用的内存预算
+DECODE_MEMORY_BUDGET_MB = int(os.getenv('DECODE_MEMORY_BUDGET_MB', 512))
+# 排队等待的最长时间（秒）
+DECODE_QUEUE_TIMEOUT = float(os.getenv('DECODE_QUEUE_TIMEOUT', 30))
+
+# Pillow的解压炸弹保护阈值，超过两倍时Image.open直接报错
+Image.MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 200_000_000))
+
+decode_memory_in_use = Gauge('gallery_decode_memory_bytes', '正在进行的解码占用的预估内存')
+decode_rejections = Counter('gallery_decode_rejections_total', '被准入控制拒绝的解码', ('reason',))
+
+
+class AdmissionRejected(Exception):
+    """解码请求超出内存预算或等待超时，retryable表示稍后重试可能成功"""
+
+    def __init__(self, message, retryable):
+        super().__init__(message)
+        self.retryable = retryable
+
+    def __reduce__(self):
+        # 在进程池中抛出时需要能被pickle
+        return self.__class__, (str(self), self.retryable)
+
+
+# 各模式每个像素的字节数，未列出的按4字节计算
+_BYTES_PER_PIXEL = {'1': 1, 'L': 1, 'P': 1, 'LA': 2, 'RGB': 3, 'YCbCr': 3, 'RGBA': 4, 'CMYK': 4, 'I;16': 2}
+
+
+def estimate_decode_bytes(img):
+    """根据文件头中的尺寸和模式估算解码内存（包含转换、裁剪、缩放产生的副本）"""
+    width, height = img.size
+    return width * height * _BYTES_PER_PIXEL.get(img.mode, 4) * 2
+
+
+def reduce_decode_size(img, target_size):
+    """对支持降采样解码的格式（JPEG）按目标尺寸解码，解码结果不小于target_size"""
+    if img.format == 'JPEG':
+        img.draft(None, target_size)
+
+
+class DecodeAdmission:
+    def __init__(self, budget_bytes, timeout):
+        self.budget_bytes = budget_bytes
+        self.timeout = timeout
+        self._in_use = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def admit(self, estimate):
+        if estimate > self.budget_bytes:
+            decode_rejections.inc(reason='too_large')
+            raise AdmissionRejected(f'图片过大，解码需要约 {estimate // 1024 // 1024} MB内存', retryable=False)
+
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            queue_depth.inc(queue='decode')
+            try:
+                while self._in_use + estimate > self.budget_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        decode_rejections.inc(reason='timeout')
+                        raise AdmissionRejected('图片处理繁忙，请稍后重试', retryable=True)
+                    self._condition.wait(remaining)
+            finally:
+                queue_depth.dec(queue='decode')
+            self._in_use += estimate
+            decode_memory_in_use.set(self._in_use)
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_use -= estimate
+                decode_memory_in_use.set(self._in_use)
+                self._condition.notify_all()
+
+
+decode_admission = DecodeAdmission(DECODE_MEMORY_BUDGET_MB * 1024 * 1024, DECODE_QUEUE_TIMEOUT)
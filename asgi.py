@@ -0,0 +1,352 @@
+"""异步（ASGI）服务模式
+
+上传、图片下发和ZIP下载这类I/O密集的接口由asyncio处理，上传和下载都以流的方式进行，
+Pillow和exiftool的工作交给线程池；其余接口原样转发给Flask应用，JSON API保持不变。
+
+转发给Flask的请求占用WSGI线程池（ASGI_WSGI_WORKERS，默认10）中的一个线程直到响应发送完毕，
+耗时较长的接口应在这里实现为异步接口，避免占满线程池阻塞其他API。
+
+运行方式: uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import contextvars
+import functools
+import hashlib
+import mimetypes
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, FileResponse, Response, RedirectResponse, StreamingResponse
+from starlette.routing import Route, Mount
+
+import main
+from admission_utils import AdmissionRejected
+from auth_utils import verify_auth_token, verify_image_signature
+from image_utils import get_image_exif_simple
+from metrics_utils import begin_request, end_request, queue_depth, timed
+from upload_utils import load_upload_session, write_chunk
+from zip_utils import stream_zip
+
+# 图片处理（解码、缩放、exiftool）线程池
+image_executor = ThreadPoolExecutor(max_workers=int(os.getenv('ASGI_IMAGE_WORKERS', os.cpu_count() or 4)))
+# 文件读写线程池
+io_executor = ThreadPoolExecutor(max_workers=int(os.getenv('ASGI_IO_WORKERS', 32)))
+# 转发给Flask的请求使用的线程数
+WSGI_WORKERS = int(os.getenv('ASGI_WSGI_WORKERS', 10))
+
+
+async def run_in(executor, func, *args):
+    # 复制上下文，使线程池中记录的阶段耗时归入当前请求
+    context = contextvars.copy_context()
+    queue = 'image' if executor is image_executor else 'io'
+    queue_depth.inc(queue=queue)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, context.run, func, *args)
+    finally:
+        queue_depth.dec(queue=queue)
+
+
+# 在线程池中逐块取出同步迭代器的数据，不阻塞事件循环
+async def iterate_in(executor, iterator):
+    try:
+        while True:
+            chunk = await run_in(executor, next, iterator, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close:
+            await run_in(executor, close)
+
+
+# 流式响应发送完毕后再记录请求耗时
+async def finish_after_stream(body_iterator, finish):
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        finish()
+
+
+# 记录异步接口的请求耗时
+def instrumented(route):
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(request):
+            start = begin_request()
+            finish = functools.partial(end_request, start, request.method, route, 500)
+            try:
+                response = await endpoint(request)
+                finish = functools.partial(end_request, start, request.method, route, response.status_code)
+                if isinstance(response, StreamingResponse):
+                    response.body_iterator = finish_after_stream(response.body_iterator, finish)
+                    finish = None
+                return response
+            finally:
+                if finish:
+                    finish()
+        return wrapper
+    return decorator
+
+
+# 从缓存返回派生图，支持If-None-Match
+def cached_image_response(request, data, etag):
+    headers = {'ETag': f'"{etag}"'}
+    if request.headers.get('if-none-match') == headers['ETag']:
+        return Response(status_code=304, headers=headers)
+    return Response(data, media_type='image/jpeg', headers=headers)
+
+
+def read_file(folder, filename):
+    with timed('file_io'), main.storage.open(folder, filename) as f:
+        return f.read()
+
+
+def read_exif(filename):
+    with main.storage.local_copy(main.UPLOAD_FOLDER, filename) as original_path:
+        return get_image_exif_simple(original_path)
+
+
+# 按类型发送图片文件，与main.serve_image_variant的行为一致
+async def send_image_variant(request, filename, file_type):
+    # 派生图优先从内存缓存读取；启用卸载模式时由Web服务器发送文件，不经过应用内缓存
+    use_cache = main.image_cache.enabled and not main.FILE_OFFLOAD_MODE and \
+        file_type in ('thumbnail', 'compressed', 'mosaic')
+    cache_key = f'{file_type}/{filename}'
+    if use_cache:
+        cached = main.image_cache.get(cache_key)
+        if cached is not None:
+            return cached_image_response(request, *cached)
+
+    try:
+        folder = await run_in(image_executor, main.resolve_image_variant, filename, file_type)
+    except AdmissionRejected as e:
+        return JSONResponse({'error': f'文件生成失败: {str(e)}'}, status_code=503 if e.retryable else 413,
+                            headers={'Retry-After': '5'} if e.retryable else None)
+    except Exception as e:
+        return JSONResponse({'error': f'文件生成失败: {str(e)}'}, status_code=500)
+
+    if not folder:
+        return JSONResponse({'error': '文件不存在'}, status_code=404)
+
+    if use_cache:
+        generation = main.image_cache.generation(cache_key)
+        data = await run_in(io_executor, read_file, folder, filename)
+        return cached_image_response(request, data, main.image_cache.put(cache_key, data, generation))
+
+    # 对象存储直接重定向到预签名URL
+    if not main.storage.is_local:
+        url = await run_in(io_executor, main.storage.presigned_url, folder, filename)
+        return RedirectResponse(url, status_code=302)
+
+    file_path = main.storage.path(folder, filename)
+    # 卸载模式下只返回重定向头
+    if main.FILE_OFFLOAD_MODE == 'x-accel':
+        return Response(media_type=mimetypes.guess_type(file_path)[0] or 'application/octet-stream',
+                        headers={'X-Accel-Redirect': main.x_accel_location(folder, filename)})
+    if main.FILE_OFFLOAD_MODE == 'x-sendfile':
+        return Response(media_type=mimetypes.guess_type(file_path)[0] or 'application/octet-stream',
+                        headers={'X-Sendfile': os.path.abspath(file_path)})
+
+    # FileResponse分块异步读取，不会阻塞事件循环
+    return FileResponse(os.path.abspath(file_path))
+
+
+@instrumented('/api/images/<int:image_id>/file')
+async def get_image_file(request):
+    image_id = request.path_params['image_id']
+    file_type = request.query_params.get('type', 'compressed')  # compressed, thumbnail, original
+
+    image = await run_in(io_executor, main.find_image, image_id)
+    if not image:
+        return JSONResponse({'error': '图片不存在'}, status_code=404)
+
+    # 加密相册的图片需要验证token
+    if image['password_id']:
+        auth_token = request.headers.get('X-Album-Auth') or request.query_params.get('token')
+        if not auth_token or not verify_auth_token(auth_token, image['album_id']):
+            return JSONResponse({'error': '无权访问此加密相册'}, status_code=403)
+
+    response = await send_image_variant(request, image['filename'], file_type)
+    if image['password_id'] and response.status_code in (200, 304):
+        response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+
+@instrumented('/api/files/<variant>/<path:filename>')
+async def get_signed_image_file(request):
+    variant = request.path_params['variant']
+    filename = request.path_params['filename']
+    if variant not in ('thumbnail', 'compressed', 'original', 'mosaic'):
+        return JSONResponse({'error': '图片类型错误'}, status_code=400)
+
+    expires = request.query_params.get('expires')
+    signature = request.query_params.get('sig')
+    if not verify_image_signature(filename, variant, expires, signature):
+        return JSONResponse({'error': '签名无效或已过期'}, status_code=403)
+
+    response = await send_image_variant(request, filename, variant)
+    if response.status_code in (200, 304):
+        response.headers['Cache-Control'] = f"public, max-age={max(int(expires) - int(time.time()), 0)}"
+    return response
+
+
+@instrumented('/api/images/<int:image_id>/exif')
+async def get_image_exif(request):
+    image = await run_in(io_executor, main.find_image, request.path_params['image_id'])
+    if not image:
+        return JSONResponse({'error': '图片不存在'}, status_code=404)
+
+    if not await run_in(io_executor, main.storage.exists, main.UPLOAD_FOLDER, image['filename']):
+        return JSONResponse({'error': '原图文件不存在'}, status_code=404)
+
+    try:
+        exif = await run_in(image_executor, read_exif, image['filename'])
+        return JSONResponse({'exif': exif})
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+# 将上传的文件分块复制到临时文件，同时计算MD5
+def save_upload(source, temp_path, chunk_size=1024 * 1024):
+    md5 = hashlib.md5()
+    with timed('file_io'), open(temp_path, 'wb') as f:
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            md5.update(chunk)
+            f.write(chunk)
+    return md5.hexdigest()
+
+
+@instrumented('/api/albums/<int:album_id>/images')
+async def upload_image(request):
+    album_id = request.path_params['album_id']
+
+    # 请求体以流的方式解析，文件部分写入临时文件而不是内存
+    async with request.form() as form:
+        file = form.get('file')
+        if file is None or isinstance(file, str):
+            return JSONResponse({'error': '没有文件'}, status_code=400)
+        if file.filename == '':
+            return JSONResponse({'error': '没有选择文件'}, status_code=400)
+
+        temp_path = os.path.join(main.TEMP_FOLDER, f"{uuid.uuid4().hex}.part")
+        file_md5 = await run_in(io_executor, save_upload, file.file, temp_path)
+
+    result, status = await run_in(image_executor, main.ingest_image, album_id, temp_path, file.filename, file_md5)
+    return JSONResponse(result, status_code=status)
+
+
+class RequestStreamReader:
+    """在线程池中以同步read()读取异步请求体，供write_chunk等按流读取的函数使用"""
+
+    def __init__(self, request, loop):
+        self._chunks = request.stream()
+        self._loop = loop
+        self._buffer = bytearray()
+        self._finished = False
+
+    async def _next_chunk(self):
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return b''
+
+    def read(self, size):
+        while not self._finished and len(self._buffer) < size:
+            data = asyncio.run_coroutine_threadsafe(self._next_chunk(), self._loop).result()
+            if not data:
+                self._finished = True
+            self._buffer += data
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+# 上传单个分块，请求体直接从流写入分块文件
+@instrumented('/api/uploads/<upload_id>/chunks/<int:index>')
+async def upload_chunk(request):
+    upload_id = request.path_params['upload_id']
+    index = request.path_params['index']
+    session = await run_in(io_executor, load_upload_session, main.CHUNK_FOLDER, upload_id)
+    if not session:
+        return JSONResponse({'error': '上传会话不存在或已过期'}, status_code=404)
+
+    stream = RequestStreamReader(request, asyncio.get_running_loop())
+    try:
+        size = await run_in(io_executor, write_chunk, main.CHUNK_FOLDER, session, index, stream,
+                            request.headers.get('content-md5'))
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+
+    return JSONResponse({'index': index, 'size': size})
+
+
+# 以ZIP流的方式下载原图，压缩包在IO线程池中逐块生成
+async def zip_download_response(request, images, download_name):
+    auth_token = request.headers.get('X-Album-Auth') or request.query_params.get('token')
+    if not main.zip_download_allowed(images, auth_token):
+        return JSONResponse({'error': '无权访问此加密相册'}, status_code=403)
+
+    return StreamingResponse(iterate_in(io_executor, stream_zip(main.zip_entries(images))),
+                             media_type='application/zip',
+                             headers={'Content-Disposition': main.zip_content_disposition(download_name)})
+
+
+@instrumented('/api/albums/<int:album_id>/download')
+async def download_album(request):
+    album, images = await run_in(io_executor, main.find_album_download, request.path_params['album_id'])
+    if not album:
+        return JSONResponse({'error': '相册不存在'}, status_code=404)
+
+    return await zip_download_response(request, images, f"{album['name']}.zip")
+
+
+@instrumented('/api/images/download')
+async def download_images(request):
+    try:
+        image_ids = [int(i) for i in request.query_params.get('ids', '').split(',') if i]
+    except ValueError:
+        return JSONResponse({'error': '图片id无效'}, status_code=400)
+
+    if not image_ids:
+        return JSONResponse({'error': '请选择要下载的图片'}, status_code=400)
+
+    images = await run_in(io_executor, main.find_download_images, image_ids)
+    if len(images) != len(set(image_ids)):
+        return JSONResponse({'error': '部分图片不存在'}, status_code=404)
+
+    return await zip_download_response(request, images, main.zip_download_name())
+
+
+@asynccontextmanager
+async def lifespan(app):
+    main.init_db()
+    yield
+    image_executor.shutdown(wait=False)
+    io_executor.shutdown(wait=False)
+
+
+app = Starlette(
+    routes=[
+        Route('/api/images/{image_id:int}/file', get_image_file),
+        Route('/api/files/{variant}/{filename:path}', get_signed_image_file),
+        Route('/api/images/{image_id:int}/exif', get_image_exif),
+        Route('/api/albums/{album_id:int}/images', upload_image, methods=['POST']),
+        Route('/api/uploads/{upload_id}/chunks/{index:int}', upload_chunk, methods=['PUT']),
+        Route('/api/albums/{album_id:int}/download', download_album),
+        Route('/api/images/download', download_images),
+        # 其余接口交给Flask处理
+        Mount('/', WSGIMiddleware(main.app, workers=WSGI_WORKERS)),
+    ],
+    # 与Flask-CORS的默认配置保持一致
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan,
+)
@@ -1,9 +1,13 @@
 import hashlib
+import hmac
 import os
 import time
 
 token_expire_minutes = 10
 
+# 图片签名URL的有效窗口（秒）
+image_url_expire_seconds = int(os.getenv('IMAGE_URL_EXPIRE_SECONDS', 24 * 60 * 60))
+
 
 # 生成更安全的token
 def generate_auth_token(album_id):
@@ -51,3 +55,33 @@ def verify_auth_token(token, album_id):
 
     except:
         return False
+
+
+# 生成图片签名
+def generate_image_signature(filename, variant, expires):
+    """使用HMAC-SHA256对存储文件名、图片类型和过期时间签名"""
+    secret_key = os.getenv('TOKEN_SECRET', 'flc')
+    sign_str = f"{variant}/{filename}/{expires}"
+    return hmac.new(secret_key.encode(), sign_str.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+# 计算图片签名URL的过期时间
+def image_url_expires():
+    """过期时间对齐到窗口边界，同一窗口内生成的URL完全相同，便于CDN/代理缓存"""
+    window = image_url_expire_seconds
+    return (int(time.time()) // window + 2) * window
+
+
+# 验证图片签名
+def verify_image_signature(filename, variant, expires, signature):
+    """无状态验证图片签名，不需要查询数据库"""
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+
+    if not signature or expires < int(time.time()):
+        return False
+
+    expected_signature = generate_image_signature(filename, variant, expires)
+    return hmac.compare_digest(signature, expected_signature)
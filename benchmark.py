@@ -0,0 +1,398 @@
+"""性能基准测试
+
+构建合成图库并测量派生图生成吞吐、上传延迟、相册列表查询以及并发文件下发吞吐，
+结果以JSON格式输出，便于比较不同版本的运行结果。
+
+用法:
+    python benchmark.py build --root bench_library --albums 2000 --images 1000000
+    python benchmark.py run --root bench_library --output bench_result.json
+    python benchmark.py compare old.json new.json
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from PIL import Image
+
+# 合成原图的尺寸和格式
+ORIGINAL_SPECS = [
+    ((640, 480), 'JPEG'),
+    ((1920, 1080), 'JPEG'),
+    ((4000, 3000), 'JPEG'),
+    ((1200, 1200), 'PNG'),
+]
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_app(root):
+    """切换到图库目录后导入应用（应用使用相对路径）"""
+    os.chdir(root)
+    sys.path.insert(0, SCRIPT_DIR)
+    import main
+    # send_file的相对路径基于root_path，需与图库目录一致
+    main.app.root_path = os.getcwd()
+    main.init_db()
+    return main
+
+
+def make_image(size, fmt, seed):
+    """生成带噪声的图片，使JPEG压缩接近真实照片"""
+    rng = random.Random(seed)
+    noise = Image.effect_noise(size, rng.randint(32, 96))
+    gradient = Image.linear_gradient('L').resize(size)
+    img = Image.merge('RGB', (noise, gradient, Image.eval(noise, lambda v: 255 - v)))
+    if fmt == 'PNG':
+        img.putalpha(gradient)
+
+    buf = io.BytesIO()
+    if fmt == 'JPEG':
+        img.save(buf, fmt, quality=90)
+    else:
+        img.save(buf, fmt)
+    return buf.getvalue()
+
+
+def latency_summary(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def percentile(p):
+        return samples[min(int(len(samples) * p), len(samples) - 1)] * 1000
+
+    return {
+        'count': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000,
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def build_library(args):
+    os.makedirs(args.root, exist_ok=True)
+    main = load_app(args.root)
+    from image_utils import generate_thumbnail, generate_compressed
+
+    # 生成原图文件，数据库记录循环引用这些文件
+    filenames = []
+    for i in range(args.files):
+        size, fmt = ORIGINAL_SPECS[i % len(ORIGINAL_SPECS)]
+        filename = f"bench_{i:05d}_{size[0]}x{size[1]}.{fmt.lower()}"
+        original_path = os.path.join(main.UPLOAD_FOLDER, filename)
+        if not os.path.exists(original_path):
+            with open(original_path, 'wb') as f:
+                f.write(make_image(size, fmt, i))
+            generate_thumbnail(original_path, os.path.join(main.THUMBNAIL_FOLDER, filename))
+            generate_compressed(original_path, os.path.join(main.COMPRESSED_FOLDER, filename))
+        filenames.append((filename, size, os.path.getsize(original_path)))
+    print(f"生成原图 {len(filenames)} 个")
+
+    conn = sqlite3.connect(main.DATABASE)
+    conn.executemany('INSERT INTO albums (name, description) VALUES (?, ?)',
+                     ((f'相册 {i}', 'benchmark') for i in range(args.albums)))
+    album_ids = [row[0] for row in conn.execute('SELECT id FROM albums')]
+
+    # 相册大小不均匀，少数相册包含大量图片
+    rng = random.Random(args.seed)
+    weights = [rng.paretovariate(1.2) for _ in album_ids]
+
+    inserted = 0
+    while inserted < args.images:
+        batch_size = min(args.batch_size, args.images - inserted)
+        albums = rng.choices(album_ids, weights=weights, k=batch_size)
+        rows = []
+        for n, album_id in enumerate(albums):
+            filename, (width, height), file_size = filenames[(inserted + n) % len(filenames)]
+            rows.append((album_id, filename, filename, file_size, width, height, f'{inserted + n:032x}'))
+        conn.executemany('''
+            INSERT INTO images (album_id, filename, original_filename, file_size, width, height, file_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.commit()
+        inserted += batch_size
+        print(f"写入图片记录 {inserted}/{args.images}")
+
+    # 每个相册取第一张图片作为封面
+    conn.execute('''
+        UPDATE albums SET cover_image_id = (SELECT MIN(id) FROM images WHERE album_id = albums.id)
+        WHERE cover_image_id IS NULL
+    ''')
+    conn.commit()
+    conn.close()
+
+
+def bench_derivatives(main, iterations):
+    """测量缩略图和压缩图的生成吞吐"""
+    from image_utils import generate_thumbnail, generate_compressed
+
+    results = {}
+    for size, fmt in ORIGINAL_SPECS:
+        source = os.path.join(main.TEMP_FOLDER, f"bench_source_{size[0]}x{size[1]}.{fmt.lower()}")
+        with open(source, 'wb') as f:
+            f.write(make_image(size, fmt, 0))
+
+        for name, func in (('thumbnail', generate_thumbnail), ('compressed', generate_compressed)):
+            output = os.path.join(main.TEMP_FOLDER, f"bench_{name}.jpg")
+            samples = []
+            for _ in range(iterations):
+                start = time.perf_counter()
+                func(source, output)
+                samples.append(time.perf_counter() - start)
+            os.remove(output)
+            summary = latency_summary(samples)
+            summary['images_per_second'] = len(samples) / sum(samples)
+            results[f'{name}_{size[0]}x{size[1]}_{fmt.lower()}'] = summary
+        os.remove(source)
+    return results
+
+
+def bench_upload(main, count):
+    """通过Flask测试客户端测量上传接口延迟（每张图片内容不同，避免被查重拦截）"""
+    client = main.app.test_client()
+    album_id = client.post('/api/albums', json={'name': 'benchmark upload'}).get_json()['id']
+
+    samples = []
+    seed = int(time.time())
+    for i in range(count):
+        data = make_image((1920, 1080), 'JPEG', seed + i)
+        start = time.perf_counter()
+        response = client.post(f'/api/albums/{album_id}/images',
+                               data={'file': (io.BytesIO(data), f'upload_{i}.jpg')},
+                               content_type='multipart/form-data')
+        samples.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f'上传失败: {response.get_json()}')
+
+    client.delete(f'/api/albums/{album_id}')
+    return latency_summary(samples)
+
+
+def bench_listing(main, repeat):
+    """测量相册列表和最大相册图片列表的查询延迟"""
+    client = main.app.test_client()
+    conn = sqlite3.connect(main.DATABASE)
+    album_count, image_count = conn.execute('SELECT (SELECT COUNT(*) FROM albums), COUNT(*) FROM images').fetchone()
+    largest = conn.execute('''
+        SELECT album_id, COUNT(*) as n FROM images GROUP BY album_id ORDER BY n DESC LIMIT 1
+    ''').fetchone()
+    conn.close()
+
+    results = {'albums': album_count, 'images': image_count}
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        client.get('/api/albums')
+        samples.append(time.perf_counter() - start)
+    results['get_albums'] = latency_summary(samples)
+
+    if largest:
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            client.get(f'/api/albums/{largest[0]}/images')
+            samples.append(time.perf_counter() - start)
+        results['get_album_images'] = latency_summary(samples)
+        results['get_album_images']['album_size'] = largest[1]
+    return results
+
+
+def start_local_server(main):
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def signed_file_urls(main, base_url, limit):
+    """从相册图片列表接口获取签名URL，与前端加载图片的方式一致"""
+    conn = sqlite3.connect(main.DATABASE)
+    album_ids = [row[0] for row in conn.execute('''
+        SELECT id FROM albums WHERE id NOT IN (SELECT album_id FROM album_passwords) ORDER BY RANDOM()
+    ''')]
+    conn.close()
+
+    urls = {'thumbnail': [], 'compressed': [], 'original': []}
+    for album_id in album_ids:
+        with urllib.request.urlopen(f'{base_url}/api/albums/{album_id}/images') as response:
+            images = json.load(response)
+        for image in images[:limit - len(urls['thumbnail'])]:
+            for file_type in urls:
+                urls[file_type].append(base_url + image[f'{file_type}_url'])
+        if len(urls['thumbnail']) >= limit:
+            break
+    return urls
+
+
+def bench_serving(main, base_url, concurrency, requests_count):
+    """并发请求图片文件，测量吞吐量
+
+    同时测量按id访问的接口和前端实际使用的签名URL接口（不查库，派生图走内存缓存），
+    后者的结果以signed_为前缀。
+    """
+    conn = sqlite3.connect(main.DATABASE)
+    image_ids = [row[0] for row in conn.execute('SELECT id FROM images ORDER BY RANDOM() LIMIT 1000')]
+    conn.close()
+    if not image_ids:
+        return {}
+
+    def fetch(url):
+        start = time.perf_counter()
+        with urllib.request.urlopen(url) as response:
+            size = len(response.read())
+        return time.perf_counter() - start, size
+
+    def measure(urls):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = list(executor.map(fetch, urls))
+        elapsed = time.perf_counter() - start
+
+        summary = latency_summary([s[0] for s in samples])
+        summary['requests_per_second'] = len(samples) / elapsed
+        summary['megabytes_per_second'] = sum(s[1] for s in samples) / elapsed / 1024 / 1024
+        summary['concurrency'] = concurrency
+        return summary
+
+    results = {}
+    for file_type in ('thumbnail', 'compressed', 'original'):
+        results[file_type] = measure([f'{base_url}/api/images/{image_ids[i % len(image_ids)]}/file?type={file_type}'
+                                      for i in range(requests_count)])
+
+    signed_urls = signed_file_urls(main, base_url, len(image_ids))
+    for file_type, urls in signed_urls.items():
+        if urls:
+            results[f'signed_{file_type}'] = measure([urls[i % len(urls)] for i in range(requests_count)])
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SCRIPT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_benchmarks(args):
+    output = os.path.abspath(args.output)
+    main = load_app(args.root)
+
+    result = {
+        'started_at': datetime.now().isoformat(),
+        'git_revision': git_revision(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'params': vars(args),
+        'results': {},
+    }
+
+    selected = set(args.only.split(',')) if args.only else None
+
+    def enabled(name):
+        return selected is None or name in selected
+
+    if enabled('derivatives'):
+        print('派生图生成...')
+        result['results']['derivatives'] = bench_derivatives(main, args.iterations)
+    if enabled('upload'):
+        print('上传...')
+        result['results']['upload'] = bench_upload(main, args.uploads)
+    if enabled('listing'):
+        print('列表查询...')
+        result['results']['listing'] = bench_listing(main, args.iterations)
+    if enabled('serving'):
+        print('并发文件下发...')
+        server = None
+        base_url = args.url
+        if not base_url:
+            server, base_url = start_local_server(main)
+        try:
+            result['results']['serving'] = bench_serving(main, base_url, args.concurrency, args.requests)
+        finally:
+            if server:
+                server.shutdown()
+
+    result['finished_at'] = datetime.now().isoformat()
+    with open(output, 'w') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f'结果已写入 {output}')
+
+
+def compare_results(args):
+    """比较两次运行结果中的耗时和吞吐指标"""
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    with open(args.candidate) as f:
+        candidate = json.load(f)['results']
+
+    def flatten(data, prefix=''):
+        for key, value in data.items():
+            if isinstance(value, dict):
+                yield from flatten(value, f'{prefix}{key}.')
+            elif isinstance(value, (int, float)) and key.endswith(('_ms', '_per_second')):
+                yield f'{prefix}{key}', value
+
+    old = dict(flatten(baseline))
+    for key, new_value in flatten(candidate):
+        if key in old and old[key]:
+            change = (new_value - old[key]) / old[key] * 100
+            print(f'{key:70s} {old[key]:12.2f} -> {new_value:12.2f} ({change:+.1f}%)')
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='图库性能基准测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='构建合成图库')
+    build.add_argument('--root', default='bench_library', help='图库目录')
+    build.add_argument('--albums', type=int, default=1000)
+    build.add_argument('--images', type=int, default=100000, help='图片记录数（最多可到百万级）')
+    build.add_argument('--files', type=int, default=200, help='实际生成的原图文件数')
+    build.add_argument('--batch-size', type=int, default=10000)
+    build.add_argument('--seed', type=int, default=42)
+
+    run = subparsers.add_parser('run', help='运行基准测试')
+    run.add_argument('--root', default='bench_library', help='图库目录')
+    run.add_argument('--output', default='bench_result.json')
+    run.add_argument('--only', help='只运行指定项目，逗号分隔: derivatives,upload,listing,serving')
+    run.add_argument('--iterations', type=int, default=20)
+    run.add_argument('--uploads', type=int, default=20)
+    run.add_argument('--url', help='对已运行的服务测试文件下发，默认启动本地服务')
+    run.add_argument('--concurrency', type=int, default=32)
+    run.add_argument('--requests', type=int, default=2000)
+
+    compare = subparsers.add_parser('compare', help='比较两次运行结果')
+    compare.add_argument('baseline')
+    compare.add_argument('candidate')
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        build_library(args)
+    elif args.command == 'run':
+        run_benchmarks(args)
+    else:
+        compare_results(args)
+
+
+if __name__ == '__main__':
+    main_cli()
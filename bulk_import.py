@@ -0,0 +1,250 @@
+"""批量导入已有照片目录
+
+遍历目录树，每个包含图片的文件夹对应一个相册（按相对路径命名），按file_hash查重，
+在进程池中并行计算哈希和生成派生图，按批次在一个事务中写入数据库，并记录导入进度，
+中断后重新运行会跳过已完成的文件。
+
+用法:
+    python bulk_import.py /mnt/photos --workers 8 --mode hardlink
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from PIL import Image
+
+from image_utils import calculate_file_md5
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff'}
+
+
+def init_checkpoint_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS import_checkpoints (
+            path TEXT PRIMARY KEY,
+            file_size INTEGER,
+            mtime REAL,
+            file_hash TEXT,
+            image_id INTEGER,
+            status TEXT NOT NULL,
+            message TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+
+def scan_files(source_dir):
+    """遍历目录，返回 (相册名, 文件路径, 大小, 修改时间)，无法读取的文件大小和修改时间为None"""
+    source_dir = os.path.abspath(source_dir)
+    root_name = os.path.basename(source_dir.rstrip(os.sep))
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames.sort()
+        relative = os.path.relpath(dirpath, source_dir)
+        album_name = root_name if relative == '.' else relative.replace(os.sep, ' / ')
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # 失效的符号链接或已被删除的文件，在计算哈希时记录为失败
+                yield album_name, path, None, None
+                continue
+            yield album_name, path, stat.st_size, stat.st_mtime
+
+
+def hash_file(path):
+    """返回 (哈希, 错误信息)，单个文件无法读取时不影响整批导入"""
+    try:
+        return calculate_file_md5(path), None
+    except OSError as e:
+        return None, str(e)
+
+
+def import_file(path, file_md5, mode):
+    """在工作进程中执行：读取尺寸、生成派生图并把原图放入存储
+
+    move模式下这里只复制，源文件在数据库记录提交后由主进程删除，中断时不会丢失文件。
+    """
+    import main
+
+    # 文件名加入哈希前缀，避免同一秒内导入的同名文件冲突
+    filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{file_md5[:8]}_{os.path.basename(path)}"
+
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+        file_size = os.path.getsize(path)
+
+        # 派生图直接从源文件生成，原图最后放入存储（对象存储不支持硬链接，按复制处理）
+        main.generate_image_variant(filename, 'thumbnail', path)
+        main.generate_image_variant(filename, 'compressed', path)
+        main.storage.put_file(main.UPLOAD_FOLDER, filename, path, mode='copy' if mode == 'move' else mode)
+    except Exception:
+        # 失败时清理已保存的文件，源文件保持不变
+        main.delete_image_files(filename)
+        raise
+
+    return filename, file_size, width, height
+
+
+def remove_source(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def get_or_create_album(conn, album_cache, album_name):
+    if album_name not in album_cache:
+        album = conn.execute('SELECT id FROM albums WHERE name = ? ORDER BY id LIMIT 1', (album_name,)).fetchone()
+        if album:
+            album_cache[album_name] = album['id']
+        else:
+            cursor = conn.execute('INSERT INTO albums (name) VALUES (?)', (album_name,))
+            album_cache[album_name] = cursor.lastrowid
+    return album_cache[album_name]
+
+
+def save_checkpoint(conn, path, file_size, mtime, file_hash, image_id, status, message=None):
+    conn.execute('''
+        INSERT OR REPLACE INTO import_checkpoints (path, file_size, mtime, file_hash, image_id, status, message)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (path, file_size, mtime, file_hash, image_id, status, message))
+
+
+def import_batch(main, conn, executor, batch, album_cache, mode):
+    """处理一批文件：并行哈希 -> 查重 -> 并行生成派生图 -> 单个事务写入"""
+    stats = {'imported': 0, 'duplicate': 0, 'error': 0}
+    changed_albums = set()
+    imported_paths = []
+
+    hashes = list(executor.map(hash_file, [item[1] for item in batch]))
+
+    # 与数据库以及同批次内的文件查重
+    seen = set()
+    pending = []
+    for (album_name, path, file_size, mtime), (file_md5, error) in zip(batch, hashes):
+        if error:
+            save_checkpoint(conn, path, file_size, mtime, None, None, 'error', error)
+            stats['error'] += 1
+            continue
+        existing = conn.execute('SELECT id FROM images WHERE file_hash = ?', (file_md5,)).fetchone()
+        if existing or file_md5 in seen:
+            save_checkpoint(conn, path, file_size, mtime, file_md5, existing['id'] if existing else None, 'duplicate')
+            stats['duplicate'] += 1
+            continue
+        seen.add(file_md5)
+        pending.append((album_name, path, file_size, mtime, file_md5))
+
+    futures = [
+        executor.submit(import_file, path, file_md5, mode)
+        for _, path, _, _, file_md5 in pending
+    ]
+
+    for (album_name, path, file_size, mtime, file_md5), future in zip(pending, futures):
+        try:
+            filename, stored_size, width, height = future.result()
+        except Exception as e:
+            save_checkpoint(conn, path, file_size, mtime, file_md5, None, 'error', str(e))
+            stats['error'] += 1
+            continue
+
+        album_id = get_or_create_album(conn, album_cache, album_name)
+        cursor = conn.execute('''
+            INSERT INTO images (album_id, filename, original_filename, file_size, width, height, file_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (album_id, filename, os.path.basename(path), stored_size, width, height, file_md5))
+        save_checkpoint(conn, path, file_size, mtime, file_md5, cursor.lastrowid, 'done')
+        stats['imported'] += 1
+        changed_albums.add(album_id)
+        imported_paths.append(path)
+
+    if changed_albums:
+        main.invalidate_home_payload(conn)
+    conn.commit()
+
+    # 记录和检查点提交后再删除源文件
+    if mode == 'move':
+        for path in imported_paths:
+            remove_source(path)
+
+    # 更新本批次涉及的相册拼图
+    for album_id in changed_albums:
+        try:
+            main.refresh_album_mosaic(album_id)
+        except Exception as e:
+            print(f'生成相册 {album_id} 的拼图失败: {e}')
+    return stats
+
+
+def run_import(args):
+    source_dir = os.path.abspath(args.source)
+    os.chdir(args.root)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    main.init_db()
+    conn = main.get_db_connection()
+    init_checkpoint_table(conn)
+
+    # 已完成的文件（路径、大小和修改时间都未变化）直接跳过
+    finished = {
+        row['path']: (row['file_size'], row['mtime'], row['status'])
+        for row in conn.execute("SELECT path, file_size, mtime, status FROM import_checkpoints WHERE status != 'error'")
+    }
+
+    totals = {'imported': 0, 'duplicate': 0, 'error': 0, 'skipped': 0}
+    album_cache = {}
+    start = time.time()
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        batch = []
+        for item in scan_files(source_dir):
+            _, path, file_size, mtime = item
+            checkpoint = finished.get(path)
+            if checkpoint and checkpoint[:2] == (file_size, mtime):
+                # 上次在提交后、删除源文件前中断
+                if args.mode == 'move' and checkpoint[2] == 'done':
+                    remove_source(path)
+                totals['skipped'] += 1
+                continue
+            batch.append(item)
+
+            if len(batch) >= args.batch_size:
+                for key, value in import_batch(main, conn, executor, batch, album_cache, args.mode).items():
+                    totals[key] += value
+                batch = []
+                print_progress(totals, start)
+
+        if batch:
+            for key, value in import_batch(main, conn, executor, batch, album_cache, args.mode).items():
+                totals[key] += value
+            print_progress(totals, start)
+
+    conn.close()
+    print('导入完成')
+
+
+def print_progress(totals, start):
+    elapsed = time.time() - start
+    processed = totals['imported'] + totals['duplicate'] + totals['error']
+    rate = processed / elapsed if elapsed else 0
+    print(f"已导入 {totals['imported']}，重复 {totals['duplicate']}，失败 {totals['error']}，"
+          f"跳过 {totals['skipped']}，{rate:.1f} 张/秒")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='批量导入照片目录')
+    parser.add_argument('source', help='要导入的照片目录')
+    parser.add_argument('--root', default='.', help='图库目录（gallery.db所在目录）')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=500, help='每个事务写入的文件数')
+    parser.add_argument('--mode', choices=['copy', 'hardlink', 'move'], default='copy',
+                        help='原图放入上传目录的方式，hardlink要求在同一文件系统')
+    run_import(parser.parse_args())
@@ -0,0 +1,244 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows下不支持跨进程共享
+    fcntl = None
+
+
+class SharedSegment:
+    """基于内存映射文件的跨进程共享缓存段（直接映射，每个key固定落在一个槽位）
+
+    文件开头是失效代数表，key失效时对应的代数加一，各进程本地缓存的条目据此判断是否过期。
+    """
+
+    # 槽位头: key摘要(16字节) + 数据长度(4字节) + etag(32字节)
+    HEADER = struct.Struct('16sI32s')
+    GENERATION = struct.Struct('I')
+    GENERATION_COUNT = 65536
+
+    def __init__(self, path, size_bytes, slot_bytes):
+        self.slot_bytes = slot_bytes
+        self.slot_count = max(size_bytes // slot_bytes, 1)
+        self.max_data_bytes = slot_bytes - self.HEADER.size
+        self._slots_start = self.GENERATION_COUNT * self.GENERATION.size
+
+        # flock按文件描述符加锁，同一进程的线程共用描述符，线程之间另用线程锁互斥
+        self._thread_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a+b')
+        total = self._slots_start + self.slot_count * slot_bytes
+        if os.fstat(self._file.fileno()).st_size < total:
+            self._file.truncate(total)
+        self._mmap = mmap.mmap(self._file.fileno(), total)
+
+    def _locate(self, key):
+        digest = hashlib.md5(key.encode()).digest()
+        offset = self._slots_start + int.from_bytes(digest[:8], 'big') % self.slot_count * self.slot_bytes
+        return digest, offset
+
+    def _generation_offset(self, digest):
+        return int.from_bytes(digest[8:12], 'big') % self.GENERATION_COUNT * self.GENERATION.size
+
+    def _read_generation(self, digest):
+        return self.GENERATION.unpack_from(self._mmap, self._generation_offset(digest))[0]
+
+    def generation(self, key):
+        digest, _ = self._locate(key)
+        with self._locked(fcntl.LOCK_SH):
+            return self._read_generation(digest)
+
+    @contextmanager
+    def _locked(self, mode):
+        with self._thread_lock:
+            fcntl.flock(self._file.fileno(), mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def get(self, key):
+        """返回 (data, etag, 代数)，未命中返回None"""
+        digest, offset = self._locate(key)
+        with self._locked(fcntl.LOCK_SH):
+            slot_digest, length, etag = self.HEADER.unpack_from(self._mmap, offset)
+            if slot_digest != digest or length == 0:
+                return None
+            start = offset + self.HEADER.size
+            return self._mmap[start:start + length], etag.decode(), self._read_generation(digest)
+
+    def put(self, key, data, etag, generation):
+        """generation为读取数据前的代数，期间key已失效时不写入"""
+        if len(data) > self.max_data_bytes:
+            return False
+        digest, offset = self._locate(key)
+        with self._locked(fcntl.LOCK_EX):
+            if self._read_generation(digest) != generation:
+                return False
+            self.HEADER.pack_into(self._mmap, offset, digest, len(data), etag.encode())
+            start = offset + self.HEADER.size
+            self._mmap[start:start + len(data)] = data
+            return True
+
+    def invalidate(self, key):
+        digest, offset = self._locate(key)
+        with self._locked(fcntl.LOCK_EX):
+            slot_digest, _, _ = self.HEADER.unpack_from(self._mmap, offset)
+            if slot_digest == digest:
+                self.HEADER.pack_into(self._mmap, offset, b'', 0, b'')
+            generation_offset = self._generation_offset(digest)
+            generation = self.GENERATION.unpack_from(self._mmap, generation_offset)[0]
+            self.GENERATION.pack_into(self._mmap, generation_offset, (generation + 1) & 0xFFFFFFFF)
+
+
+class LRUByteCache:
+    """按字节数限制大小的LRU缓存，保存编码后的派生图数据及其ETag
+
+    每个条目记录写入时的失效代数。使用共享段时代数保存在共享段中，
+    任一进程（包括维护任务）使key失效后，其他进程本地缓存的旧条目也不会再被使用。
+    """
+
+    LOCAL_GENERATION_COUNT = 4096
+
+    def __init__(self, max_bytes, max_entry_bytes, shared=None):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # 未使用共享段时的本进程失效代数
+        self._generations = [0] * self.LOCAL_GENERATION_COUNT
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'shared_hits': 0, 'invalidations': 0,
+                       'stale': 0}
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _local_index(self, key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[8:12], 'big') % self.LOCAL_GENERATION_COUNT
+
+    def generation(self, key):
+        """读取数据前调用，结果传给put，期间key失效时put不会写入旧数据"""
+        if self.shared is not None:
+            return self.shared.generation(key)
+        with self._lock:
+            return self._generations[self._local_index(key)]
+
+    def get(self, key):
+        """返回 (data, etag)，未命中返回None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        # 本进程的条目需要确认没有被其他进程标记为失效
+        if entry is not None and self.shared is not None and entry[2] != self.shared.generation(key):
+            self._discard(key, entry)
+            entry = None
+        if entry is not None:
+            with self._lock:
+                self._stats['hits'] += 1
+            return entry[:2]
+
+        # 本进程未命中时查询共享段，命中后放入本进程缓存
+        if self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                with self._lock:
+                    self._stats['shared_hits'] += 1
+                self._store(key, *entry)
+                return entry[:2]
+
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def put(self, key, data, generation=None):
+        """写入缓存并返回ETag，generation为读取数据前调用generation()的结果"""
+        etag = hashlib.md5(data).hexdigest()
+        if len(data) <= self.max_entry_bytes:
+            if generation is None:
+                generation = self.generation(key)
+            if self._store(key, data, etag, generation) and self.shared is not None:
+                self.shared.put(key, data, etag, generation)
+        return etag
+
+    def _store(self, key, data, etag, generation):
+        with self._lock:
+            # 读取数据期间key已失效，不写入旧数据
+            if self.shared is None and generation != self._generations[self._local_index(key)]:
+                return False
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[0])
+            self._entries[key] = (data, etag, generation)
+            self._size += len(data)
+
+            # 超出容量时淘汰最久未使用的条目
+            while self._size > self.max_bytes and self._entries:
+                _, (evicted, _, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self._stats['evictions'] += 1
+            return True
+
+    def _discard(self, key, entry):
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+                self._size -= len(entry[0])
+                self._stats['stale'] += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= len(entry[0])
+            self._generations[self._local_index(key)] += 1
+            self._stats['invalidations'] += 1
+        if self.shared is not None:
+            self.shared.invalidate(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['shared_hits'] + self._stats['misses']
+            hits = self._stats['hits'] + self._stats['shared_hits']
+            return {
+                **self._stats,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hit_rate': round(hits / lookups, 4) if lookups else 0,
+                'shared': self.shared is not None,
+            }
+
+
+def create_image_cache():
+    """根据环境变量创建派生图缓存"""
+    max_bytes = int(os.getenv('IMAGE_CACHE_MAX_MB', 64)) * 1024 * 1024
+    max_entry_bytes = int(os.getenv('IMAGE_CACHE_MAX_ENTRY_KB', 1024)) * 1024
+
+    # 同一台机器上的worker进程和维护任务通过共享段共享缓存和失效信息，默认放在临时目录
+    shared = None
+    shared_path = os.getenv('IMAGE_CACHE_SHARED_PATH', os.path.join('tmp', 'image_cache.bin'))
+    if shared_path and fcntl is not None and max_bytes > 0:
+        shared_mb = int(os.getenv('IMAGE_CACHE_SHARED_MB', 256))
+        # 槽位大小按缩略图设置，放不下的条目只保存在本进程
+        slot_kb = int(os.getenv('IMAGE_CACHE_SHARED_SLOT_KB', 64))
+        shared = SharedSegment(shared_path, shared_mb * 1024 * 1024, slot_kb * 1024)
+    elif os.getenv('IMAGE_CACHE_LOCAL_ONLY', '').lower() not in ('1', 'true', 'yes'):
+        # 没有共享段时其他进程的失效无法送达，本进程会一直返回旧数据，
+        # 只有明确声明为单进程部署（且不运行维护任务）时才启用进程内缓存
+        max_bytes = 0
+
+    return LRUByteCache(max_bytes, max_entry_bytes, shared)
@@ -1,56 +1,89 @@
+import hashlib
 import json
+import math
 import subprocess
 
 from PIL import Image
 
+from admission_utils import decode_admission, estimate_decode_bytes, reduce_decode_size
+from metrics_utils import timed_stage
 
+
+# 分块计算文件MD5
+@timed_stage('hash')
+def calculate_file_md5(file_path, chunk_size=1024 * 1024):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+@timed_stage('thumbnail')
 def generate_thumbnail(image_path, output_path, size=(250, 250)):
     with Image.open(image_path) as img:
-        # 转换为RGB模式
-        if img.mode in ('RGBA', 'LA'):
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            background.paste(img, mask=img.split()[-1])
-            img = background
-
-        # 计算裁剪区域，保持居中裁剪
-        width, height = img.size
-        # 选择较短的边作为裁剪尺寸
-        crop_size = min(width, height)
-        # 计算裁剪区域（居中）
-        left = (width - crop_size) // 2
-        top = (height - crop_size) // 2
-        right = left + crop_size
-        bottom = top + crop_size
-
-        # 裁剪为正方形
-        img_cropped = img.crop((left, top, right, bottom))
-        # 调整到目标尺寸
-        img_resized = img_cropped.resize(size, Image.Resampling.LANCZOS)
-        img_resized.save(output_path, 'JPEG', quality=80)
+        # 按缩略图尺寸降采样解码，短边不小于目标尺寸
+        short_side = min(img.size)
+        if short_side > max(size):
+            ratio = short_side / max(size)
+            reduce_decode_size(img, (math.ceil(img.width / ratio), math.ceil(img.height / ratio)))
+
+        # 在进程内存预算内解码
+        with decode_admission.admit(estimate_decode_bytes(img)):
+            # 转换为RGB模式
+            if img.mode in ('RGBA', 'LA'):
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.split()[-1])
+                img = background
+
+            # 计算裁剪区域，保持居中裁剪
+            width, height = img.size
+            # 选择较短的边作为裁剪尺寸
+            crop_size = min(width, height)
+            # 计算裁剪区域（居中）
+            left = (width - crop_size) // 2
+            top = (height - crop_size) // 2
+            right = left + crop_size
+            bottom = top + crop_size
+
+            # 裁剪为正方形
+            img_cropped = img.crop((left, top, right, bottom))
+            # 调整到目标尺寸
+            img_resized = img_cropped.resize(size, Image.Resampling.LANCZOS)
+            img_resized.save(output_path, 'JPEG', quality=80)
 
 
 # 生成压缩图
+@timed_stage('compressed')
 def generate_compressed(image_path, output_path, max_size=1200):
     with Image.open(image_path) as img:
-        # 转换为RGB模式
-        if img.mode in ('RGBA', 'LA'):
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            background.paste(img, mask=img.split()[-1])
-            img = background
-
-        # 计算新尺寸，保持宽高比
+        # 按压缩图尺寸降采样解码
         if img.width > max_size or img.height > max_size:
-            if img.width > img.height:
-                new_width = max_size
-                new_height = int(img.height * max_size / img.width)
-            else:
-                new_height = max_size
-                new_width = int(img.width * max_size / img.height)
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-
-        img.save(output_path, 'JPEG', quality=80)
-
-
+            ratio = max(img.size) / max_size
+            reduce_decode_size(img, (math.ceil(img.width / ratio), math.ceil(img.height / ratio)))
+
+        # 在进程内存预算内解码
+        with decode_admission.admit(estimate_decode_bytes(img)):
+            # 转换为RGB模式
+            if img.mode in ('RGBA', 'LA'):
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.split()[-1])
+                img = background
+
+            # 计算新尺寸，保持宽高比
+            if img.width > max_size or img.height > max_size:
+                if img.width > img.height:
+                    new_width = max_size
+                    new_height = int(img.height * max_size / img.width)
+                else:
+                    new_height = max_size
+                    new_width = int(img.width * max_size / img.height)
+                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+
+            img.save(output_path, 'JPEG', quality=80)
+
+
+@timed_stage('exif')
 def get_image_exif_all(image_path):
     try:
         # 使用exiftool获取EXIF信息
@@ -70,6 +103,7 @@ def get_image_exif_all(image_path):
         raise Exception(f'获取EXIF信息失败: {str(e)}')
 
 
+@timed_stage('exif')
 def get_image_exif_simple(image_path):
     try:
         # 定义精简的EXIF字段
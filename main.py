@@ -1,19 +1,69 @@
+import functools
 import hashlib
+import json
+import mimetypes
 import os
 import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime
+from urllib.parse import quote
 
 from PIL import Image
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, g, stream_with_context, redirect
 from flask_cors import CORS
 
-from auth_utils import verify_auth_token, generate_auth_token, token_expire_minutes
-from image_utils import generate_thumbnail, generate_compressed, get_image_exif_simple
+from auth_utils import verify_auth_token, generate_auth_token, token_expire_minutes, \
+    generate_image_signature, verify_image_signature, image_url_expires, image_url_expire_seconds
+from admission_utils import AdmissionRejected
+from cache_utils import create_image_cache
+from storage_utils import create_storage
+from zip_utils import stream_zip
+from upload_utils import create_upload_session, load_upload_session, write_chunk, received_chunks, \
+    assemble_upload, delete_upload_session, claim_upload_session, release_upload_session
+from metrics_utils import TimedConnection, begin_request, end_request, timed, render_metrics, \
+    derivative_regenerations, Gauge
+from image_utils import generate_thumbnail, generate_compressed, get_image_exif_simple, calculate_file_md5
+from mosaic_utils import MOSAIC_IMAGE_COUNT, mosaic_signature, build_mosaic
 
 app = Flask(__name__)
 CORS(app)
 
 
+# 请求耗时统计
+@app.before_request
+def start_request_timer():
+    g.request_start = begin_request()
+
+
+def finish_request_timer(start, status):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    return functools.partial(end_request, start, request.method, route, status)
+
+
+@app.after_request
+def record_response_status(response):
+    if 'request_start' in g:
+        # 由生成器输出的流式响应（ZIP下载）在响应体发送完毕后再记录；
+        # send_file的direct_passthrough响应不会触发关闭回调，按普通响应处理
+        if response.is_streamed and not response.direct_passthrough:
+            response.call_on_close(finish_request_timer(g.pop('request_start'), response.status_code))
+        else:
+            g.response_status = response.status_code
+    return response
+
+
+# 抛出异常时after_request不会执行，在teardown中记录，保证正在处理的请求数能够归零
+@app.teardown_request
+def record_request_metrics(exc):
+    if 'request_start' in g:
+        status = 500 if exc is not None else g.pop('response_status', 500)
+        finish_request_timer(g.pop('request_start'), status)()
+
+
 # 服务前端页面
 @app.route('/')
 def index():
@@ -33,10 +83,33 @@ def serve_static(path):
 UPLOAD_FOLDER = 'uploads'
 THUMBNAIL_FOLDER = 'thumbnails'
 COMPRESSED_FOLDER = 'compressed'
+MOSAIC_FOLDER = 'mosaics'
+TEMP_FOLDER = 'tmp'
+CHUNK_FOLDER = os.path.join(TEMP_FOLDER, 'chunks')
 DATABASE = 'gallery.db'
 
-# 确保目录存在
-for folder in [UPLOAD_FOLDER, THUMBNAIL_FOLDER, COMPRESSED_FOLDER]:
+# 文件下发卸载模式：''（Flask直接发送）、'x-accel'（nginx）、'x-sendfile'（Apache/lighttpd）
+# 卸载模式下应用只负责查库和权限检查，由Web服务器完成零拷贝传输，例如nginx：
+#   location /protected/ { internal; alias /srv/gallery/; }
+FILE_OFFLOAD_MODE = os.getenv('FILE_OFFLOAD_MODE', '').lower()
+# nginx internal location前缀，对应应用工作目录
+X_ACCEL_PREFIX = os.getenv('X_ACCEL_PREFIX', '/protected')
+
+# 启用卸载模式后派生图不再使用应用内的内存缓存（IMAGE_CACHE_MAX_MB）
+# X-Sendfile由Flask的send_file原生支持
+app.config['USE_X_SENDFILE'] = FILE_OFFLOAD_MODE == 'x-sendfile'
+
+# 各类型图片所在目录
+VARIANT_FOLDERS = {'original': UPLOAD_FOLDER, 'thumbnail': THUMBNAIL_FOLDER, 'compressed': COMPRESSED_FOLDER}
+
+# 原图和派生图的存储后端（本地目录或S3兼容对象存储）
+storage = create_storage()
+
+# 热点派生图（缩略图、压缩图）内存缓存
+image_cache = create_image_cache()
+
+# 确保目录存在（临时目录始终在本地）
+for folder in [TEMP_FOLDER, CHUNK_FOLDER] + (list(VARIANT_FOLDERS.values()) + [MOSAIC_FOLDER] if storage.is_local else []):
     os.makedirs(folder, exist_ok=True)
 
 
@@ -89,23 +162,46 @@ def init_db():
             )
         ''')
 
+    # 上传和批量导入按MD5查重
+    c.execute('CREATE INDEX IF NOT EXISTS idx_images_file_hash ON images (file_hash)')
+    # 按相册查询图片列表、图片数量和拼图素材
+    c.execute('CREATE INDEX IF NOT EXISTS idx_images_album_uploaded ON images (album_id, uploaded_at)')
+
+    # 相册封面拼图，signature不变时复用已生成的拼图
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS album_mosaics (
+            album_id INTEGER PRIMARY KEY,
+            signature TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 站点配置表，首页数据版本号也保存在这里
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS site_config (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT UNIQUE NOT NULL,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
     conn.commit()
     conn.close()
 
 
 # 数据库连接
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
+    conn = sqlite3.connect(DATABASE, factory=TimedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
 
 # API路由
 
-# 获取所有相册
-@app.route('/api/albums', methods=['GET'])
-def get_albums():
-    conn = get_db_connection()
+# 查询相册列表（含封面、图片数量和是否加密）
+def list_albums(conn):
     albums = conn.execute('''
         SELECT a.*, i.filename as cover_filename,
         (SELECT COUNT(*) FROM images WHERE album_id = a.id) as image_count,
@@ -114,9 +210,185 @@ def get_albums():
         LEFT JOIN images i ON a.cover_image_id = i.id
         LEFT JOIN album_passwords ap ON a.id = ap.album_id
     ''').fetchall()
+
+    result = []
+    for album in albums:
+        album = dict(album)
+        # 封面使用签名URL以便缓存；加密相册的封面需要凭token访问，不下发签名URL
+        album['cover_url'] = signed_image_url(album['cover_filename'], 'thumbnail') \
+            if album['cover_filename'] and not album['has_password'] else None
+        result.append(album)
+    return result
+
+
+# 获取所有相册
+@app.route('/api/albums', methods=['GET'])
+def get_albums():
+    conn = get_db_connection()
+    result = list_albums(conn)
+    conn.close()
+
+    return jsonify(result)
+
+
+# 首页数据版本号加一，与写操作在同一事务中提交，所有进程和节点都能看到
+def invalidate_home_payload(conn):
+    conn.execute('''
+        INSERT INTO site_config (key, value) VALUES ('home_version', '1')
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1, updated_at = CURRENT_TIMESTAMP
+    ''')
+
+
+# 删除相册拼图
+def delete_album_mosaic(conn, album_id):
+    mosaic = conn.execute('SELECT filename FROM album_mosaics WHERE album_id = ?', (album_id,)).fetchone()
+    if mosaic:
+        storage.delete(MOSAIC_FOLDER, mosaic['filename'])
+        image_cache.invalidate(f"mosaic/{mosaic['filename']}")
+        conn.execute('DELETE FROM album_mosaics WHERE album_id = ?', (album_id,))
+
+
+# 相册排在最前面的N张图片，加密相册不生成拼图，避免在首页泄露相册内容
+def album_mosaic_images(conn, album_id):
+    if conn.execute('SELECT id FROM album_passwords WHERE album_id = ?', (album_id,)).fetchone():
+        return []
+    rows = conn.execute('''
+        SELECT filename FROM images WHERE album_id = ? ORDER BY uploaded_at DESC, id DESC LIMIT ?
+    ''', (album_id, MOSAIC_IMAGE_COUNT)).fetchall()
+    return [row['filename'] for row in rows]
+
+
+# 用压缩图生成相册拼图并保存到存储，返回拼图文件名
+def generate_album_mosaic(album_id, filenames, signature):
+    # 文件名包含签名，内容变化后URL随之变化，旧的缓存不会被误用
+    mosaic_filename = f'{album_id}_{signature[:16]}.jpg'
+    temp_path = os.path.join(TEMP_FOLDER, f"{uuid.uuid4().hex}.jpg")
+    try:
+        with ExitStack() as stack:
+            image_paths = []
+            for filename in filenames:
+                folder = resolve_image_variant(filename, 'compressed')
+                if folder:
+                    image_paths.append(stack.enter_context(storage.local_copy(folder, filename)))
+            if not image_paths:
+                return None
+            build_mosaic(image_paths, temp_path)
+        storage.put_file(MOSAIC_FOLDER, mosaic_filename, temp_path, mode='move')
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return mosaic_filename
+
+
+# 重新生成一个相册的拼图，前N张图片没有变化时直接返回False
+def refresh_album_mosaic(album_id):
+    conn = get_db_connection()
+    try:
+        filenames = album_mosaic_images(conn, album_id)
+        signature = mosaic_signature(filenames) if filenames else None
+        current = conn.execute('SELECT signature FROM album_mosaics WHERE album_id = ?', (album_id,)).fetchone()
+        if (current['signature'] if current else None) == signature:
+            return False
+
+        # 生成拼图期间不占用数据库写锁
+        mosaic_filename = generate_album_mosaic(album_id, filenames, signature) if filenames else None
+
+        # 写入前确认相册内容在生成期间没有再次变化，多个进程同时生成时以数据库中的记录为准
+        conn.execute('BEGIN IMMEDIATE')
+        latest = album_mosaic_images(conn, album_id)
+        current = conn.execute('SELECT filename FROM album_mosaics WHERE album_id = ?', (album_id,)).fetchone()
+        old_filename = current['filename'] if current else None
+        if (mosaic_signature(latest) if latest else None) != signature:
+            # 内容已变化，丢弃本次结果，由之后的刷新重新生成
+            conn.rollback()
+            if mosaic_filename and mosaic_filename != old_filename:
+                storage.delete(MOSAIC_FOLDER, mosaic_filename)
+            return False
+
+        if mosaic_filename:
+            conn.execute('INSERT OR REPLACE INTO album_mosaics (album_id, signature, filename) VALUES (?, ?, ?)',
+                         (album_id, signature, mosaic_filename))
+        else:
+            conn.execute('DELETE FROM album_mosaics WHERE album_id = ?', (album_id,))
+        invalidate_home_payload(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+    # 记录已指向新拼图后再删除旧文件（签名相同时文件名相同，不能删除）
+    if old_filename and old_filename != mosaic_filename:
+        storage.delete(MOSAIC_FOLDER, old_filename)
+        image_cache.invalidate(f'mosaic/{old_filename}')
+    return True
+
+
+# 拼图在后台线程中生成，写操作只登记需要刷新的相册
+mosaic_executor = ThreadPoolExecutor(max_workers=1)
+pending_mosaic_albums = set()
+pending_mosaic_lock = threading.Lock()
+
+
+def run_mosaic_refresh(album_id):
+    # 开始前移出等待集合，生成期间相册再次变化时会重新登记
+    with pending_mosaic_lock:
+        pending_mosaic_albums.discard(album_id)
+    try:
+        refresh_album_mosaic(album_id)
+    except Exception:
+        app.logger.exception('生成相册 %s 的拼图失败', album_id)
+
+
+# 登记需要刷新拼图的相册，同一相册的多次修改合并为一次刷新
+def schedule_mosaic_refresh(*album_ids):
+    with pending_mosaic_lock:
+        album_ids = set(album_ids) - pending_mosaic_albums
+        pending_mosaic_albums.update(album_ids)
+    for album_id in album_ids:
+        mosaic_executor.submit(run_mosaic_refresh, album_id)
+
+
+# 生成首页数据：站点标题和相册列表（含封面和拼图的签名URL），拼图只读取已生成的记录
+def build_home_payload(conn):
+    title_record = conn.execute('SELECT value FROM site_config WHERE key = ?', ('site_title',)).fetchone()
+    mosaics = {row['album_id']: row['filename']
+               for row in conn.execute('SELECT album_id, filename FROM album_mosaics').fetchall()}
+
+    albums = list_albums(conn)
+    for album in albums:
+        album['mosaic_url'] = signed_image_url(mosaics[album['id']], 'mosaic') if album['id'] in mosaics else None
+
+    return {
+        'title': title_record['value'] if title_record and title_record['value'] else '我的相册',
+        'albums': albums,
+    }
+
+
+# 预先生成的首页数据，版本号或签名URL窗口变化时重建
+home_payload_cache = {'key': None, 'body': None, 'etag': None}
+home_payload_lock = threading.Lock()
+
+
+# 首页数据：一次请求即可渲染整个相册列表
+@app.route('/api/home')
+def get_home():
+    conn = get_db_connection()
+    # 先读版本号再生成数据，生成期间发生的修改会在下次请求时触发重建
+    version = conn.execute('SELECT value FROM site_config WHERE key = ?', ('home_version',)).fetchone()
+    key = (version['value'] if version else None, int(time.time()) // image_url_expire_seconds)
+
+    # 同一时间只有一个线程重建（只查库，不生成图片），其余请求等待后直接使用结果
+    with home_payload_lock:
+        if home_payload_cache['key'] != key:
+            body = json.dumps(build_home_payload(conn), ensure_ascii=False).encode('utf-8')
+            home_payload_cache.update(key=key, body=body, etag=hashlib.md5(body).hexdigest())
+        body, etag = home_payload_cache['body'], home_payload_cache['etag']
     conn.close()
 
-    return jsonify([dict(album) for album in albums])
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # 每次都向服务器确认，未变化时返回304
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 
 # 创建相册
@@ -139,6 +411,7 @@ def create_album():
         VALUES (?, ?, ?, ?, ?)
     ''', (name, description, shoot_date, model_name, location))
     album_id = cursor.lastrowid
+    invalidate_home_payload(conn)
     conn.commit()
     conn.close()
 
@@ -187,6 +460,7 @@ def update_album(album_id):
         cursor.execute(f'''
             UPDATE albums SET {', '.join(update_fields)} WHERE id = ?
         ''', values)
+        invalidate_home_payload(conn)
         conn.commit()
 
     conn.close()
@@ -203,17 +477,14 @@ def delete_album(album_id):
 
     # 删除图片文件
     for image in images:
-        original_path = os.path.join(UPLOAD_FOLDER, image['filename'])
-        thumb_path = os.path.join(THUMBNAIL_FOLDER, image['filename'])
-        compressed_path = os.path.join(COMPRESSED_FOLDER, image['filename'])
+        delete_image_files(image['filename'])
 
-        for path in [original_path, thumb_path, compressed_path]:
-            if os.path.exists(path):
-                os.remove(path)
+    delete_album_mosaic(conn, album_id)
 
     # 删除数据库记录
     conn.execute('DELETE FROM images WHERE album_id = ?', (album_id,))
     conn.execute('DELETE FROM albums WHERE id = ?', (album_id,))
+    invalidate_home_payload(conn)
     conn.commit()
     conn.close()
 
@@ -242,53 +513,200 @@ def get_album_images(album_id):
     ''', (album_id,)).fetchall()
     conn.close()
 
-    return jsonify([dict(image) for image in images])
+    result = []
+    for image in images:
+        image = dict(image)
+        # 签名URL已包含访问凭证，加密相册的图片也可以直接用于<img>标签
+        for variant in ('thumbnail', 'compressed', 'original'):
+            image[f'{variant}_url'] = signed_image_url(image['filename'], variant)
+        result.append(image)
 
+    return jsonify(result)
 
-@app.route('/api/images/<int:image_id>/file')
-def get_image_file(image_id):
-    file_type = request.args.get('type', 'compressed')  # compressed, thumbnail, original
 
+# nginx内部重定向地址，路径相对于存储根目录（与nginx的alias对应）
+def x_accel_location(folder, filename):
+    return f"{X_ACCEL_PREFIX.rstrip('/')}/{quote(folder)}/{quote(filename)}"
+
+
+# 发送图片文件（x-accel模式下只返回内部重定向头）
+def send_image_file(folder, filename):
+    # 对象存储直接重定向到预签名URL，由对象存储完成传输
+    if not storage.is_local:
+        return redirect(storage.presigned_url(folder, filename))
+
+    file_path = storage.path(folder, filename)
+    if FILE_OFFLOAD_MODE == 'x-accel':
+        mimetype = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = x_accel_location(folder, filename)
+        return response
+
+    return send_file(os.path.abspath(file_path))
+
+
+# 图片签名URL
+def signed_image_url(filename, variant):
+    expires = image_url_expires()
+    signature = generate_image_signature(filename, variant, expires)
+    return f"/api/files/{variant}/{quote(filename)}?expires={expires}&sig={signature}"
+
+
+# 从缓存发送派生图，支持If-None-Match
+def send_cached_image(data, etag):
+    response = Response(data, mimetype='image/jpeg')
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+# 读取派生图并放入缓存
+def cache_and_send_image(cache_key, folder, filename):
+    # 读取前记录失效代数，读取期间图片被删除或重新生成时不缓存旧数据
+    generation = image_cache.generation(cache_key)
+    with timed('file_io'), storage.open(folder, filename) as f:
+        data = f.read()
+    return send_cached_image(data, image_cache.put(cache_key, data, generation))
+
+
+# 使派生图缓存失效
+def invalidate_image_cache(filename):
+    for variant in ('thumbnail', 'compressed'):
+        image_cache.invalidate(f'{variant}/{filename}')
+
+
+# 删除原图和派生图
+def delete_image_files(filename):
+    for folder in VARIANT_FOLDERS.values():
+        storage.delete(folder, filename)
+    invalidate_image_cache(filename)
+
+
+# 从原图生成缩略图或压缩图并保存到存储
+def generate_image_variant(filename, file_type, original_path=None):
+    """original_path为已有的本地原图路径，未提供时从存储中获取"""
+    generate = generate_thumbnail if file_type == 'thumbnail' else generate_compressed
+    temp_path = os.path.join(TEMP_FOLDER, f"{uuid.uuid4().hex}.jpg")
+    try:
+        if original_path:
+            generate(original_path, temp_path)
+        else:
+            with storage.local_copy(UPLOAD_FOLDER, filename) as local_path:
+                generate(local_path, temp_path)
+        # 生成完成后再放入存储，读取方不会看到写了一半的文件
+        storage.put_file(VARIANT_FOLDERS[file_type], filename, temp_path, mode='move')
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+# 确保指定类型的图片存在，派生图缺失时从原图重新生成
+def resolve_image_variant(filename, file_type):
+    """返回图片所在目录，文件不存在时返回None，生成失败时抛出异常"""
+    # 相册拼图只在重建首页数据时生成
+    if file_type == 'mosaic':
+        return MOSAIC_FOLDER if storage.exists(MOSAIC_FOLDER, filename) else None
+
+    # compressed, thumbnail, original，其他值按compressed处理
+    if file_type not in VARIANT_FOLDERS:
+        file_type = 'compressed'
+    folder = VARIANT_FOLDERS[file_type]
+
+    # 检查请求的文件是否存在
+    if storage.exists(folder, filename):
+        return folder
+
+    # 如果请求的文件不存在，但原图存在，重新生成
+    if file_type != 'original' and storage.exists(UPLOAD_FOLDER, filename):
+        image_cache.invalidate(f'{file_type}/{filename}')
+        derivative_regenerations.inc(variant=file_type)
+        generate_image_variant(filename, file_type)
+
+        # 检查是否生成成功
+        if storage.exists(folder, filename):
+            return folder
+
+    return None
+
+
+# 按类型发送图片文件
+def serve_image_variant(filename, file_type):
+    # 派生图优先从内存缓存读取；启用卸载模式时由Web服务器发送文件，不经过应用内缓存
+    use_cache = image_cache.enabled and not FILE_OFFLOAD_MODE and file_type in ('thumbnail', 'compressed', 'mosaic')
+    cache_key = f'{file_type}/{filename}'
+    if use_cache:
+        cached = image_cache.get(cache_key)
+        if cached is not None:
+            return send_cached_image(*cached)
+
+    try:
+        folder = resolve_image_variant(filename, file_type)
+    except AdmissionRejected as e:
+        # 处理繁忙时提示客户端稍后重试
+        if e.retryable:
+            return jsonify({'error': f'文件生成失败: {str(e)}'}), 503, {'Retry-After': '5'}
+        return jsonify({'error': f'文件生成失败: {str(e)}'}), 413
+    except Exception as e:
+        # 生成失败，返回错误
+        return jsonify({'error': f'文件生成失败: {str(e)}'}), 500
+
+    # 其他情况返回文件不存在
+    if not folder:
+        return jsonify({'error': '文件不存在'}), 404
+
+    if use_cache:
+        return cache_and_send_image(cache_key, folder, filename)
+    return send_image_file(folder, filename)
+
+
+# 查询图片及其所在相册是否加密
+def find_image(image_id):
     conn = get_db_connection()
-    image = conn.execute('SELECT * FROM images WHERE id = ?', (image_id,)).fetchone()
+    image = conn.execute('''
+        SELECT i.*, ap.id as password_id
+        FROM images i
+        LEFT JOIN album_passwords ap ON i.album_id = ap.album_id
+        WHERE i.id = ?
+    ''', (image_id,)).fetchone()
     conn.close()
+    return image
+
+
+@app.route('/api/images/<int:image_id>/file')
+def get_image_file(image_id):
+    file_type = request.args.get('type', 'compressed')  # compressed, thumbnail, original
 
+    image = find_image(image_id)
     if not image:
         return jsonify({'error': '图片不存在'}), 404
 
-    # 获取文件路径
-    original_path = os.path.join(UPLOAD_FOLDER, image['filename'])
-    thumb_path = os.path.join(THUMBNAIL_FOLDER, image['filename'])
-    compressed_path = os.path.join(COMPRESSED_FOLDER, image['filename'])
+    # 加密相册的图片需要验证token（<img>标签无法带请求头，也可以通过token参数传递）
+    if image['password_id']:
+        auth_token = request.headers.get('X-Album-Auth') or request.args.get('token')
+        if not auth_token or not verify_auth_token(auth_token, image['album_id']):
+            return jsonify({'error': '无权访问此加密相册'}), 403
 
-    if file_type == 'original':
-        file_path = original_path
-    elif file_type == 'thumbnail':
-        file_path = thumb_path
-    else:  # compressed
-        file_path = compressed_path
+    response = serve_image_variant(image['filename'], file_type)
+    if image['password_id'] and isinstance(response, Response):
+        response.headers['Cache-Control'] = 'private, no-store'
+    return response
 
-    # 检查请求的文件是否存在
-    if os.path.exists(file_path):
-        return send_file(file_path)
 
-    # 如果请求的文件不存在，但原图存在，重新生成
-    if file_type != 'original' and os.path.exists(original_path):
-        try:
-            if file_type == 'thumbnail':
-                generate_thumbnail(original_path, thumb_path)
-            else:  # compressed
-                generate_compressed(original_path, compressed_path)
-
-            # 检查是否生成成功
-            if os.path.exists(file_path):
-                return send_file(file_path)
-        except Exception as e:
-            # 生成失败，返回错误
-            return jsonify({'error': f'文件生成失败: {str(e)}'}), 500
+# 通过签名URL获取图片，无需查询数据库
+@app.route('/api/files/<variant>/<path:filename>')
+def get_signed_image_file(variant, filename):
+    if variant not in ('thumbnail', 'compressed', 'original', 'mosaic'):
+        return jsonify({'error': '图片类型错误'}), 400
 
-    # 其他情况返回文件不存在
-    return jsonify({'error': '文件不存在'}), 404
+    expires = request.args.get('expires')
+    signature = request.args.get('sig')
+    if not verify_image_signature(filename, variant, expires, signature):
+        return jsonify({'error': '签名无效或已过期'}), 403
+
+    response = serve_image_variant(filename, variant)
+    if isinstance(response, Response) and response.status_code in (200, 304):
+        # 签名URL本身就是访问凭证，可以在过期前被CDN/代理缓存
+        response.headers['Cache-Control'] = f"public, max-age={max(int(expires) - int(time.time()), 0)}"
+    return response
 
 
 @app.route('/api/images/<int:image_id>/exif', methods=['GET'])
@@ -302,14 +720,13 @@ def get_image_exif(image_id):
 
     conn.close()
 
-    # 获取原图路径
-    original_path = os.path.join(UPLOAD_FOLDER, image['filename'])
-
-    if not os.path.exists(original_path):
+    if not storage.exists(UPLOAD_FOLDER, image['filename']):
         return jsonify({'error': '原图文件不存在'}), 404
 
     try:
-        exif = get_image_exif_simple(original_path)
+        # exiftool需要本地文件
+        with storage.local_copy(UPLOAD_FOLDER, image['filename']) as original_path:
+            exif = get_image_exif_simple(original_path)
         return jsonify({'exif': exif}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -325,15 +742,19 @@ def upload_image(album_id):
     if file.filename == '':
         return jsonify({'error': '没有选择文件'}), 400
 
-    # md5
+    # 先保存到临时文件再分块计算MD5，避免整个文件读入内存
+    temp_path = os.path.join(TEMP_FOLDER, f"{uuid.uuid4().hex}.part")
+    with timed('file_io'):
+        file.save(temp_path)
+    file_md5 = calculate_file_md5(temp_path)
 
-    # 计算文件的MD5
-    file_content = file.read()
-    file_md5 = hashlib.md5(file_content).hexdigest()
+    result, status = ingest_image(album_id, temp_path, file.filename, file_md5)
+    return jsonify(result), status
 
-    # 重置文件指针，以便后续保存
-    file.seek(0)
 
+# 图片入库：查重、保存原图、生成缩略图和压缩图并写入数据库
+def ingest_image(album_id, source_path, original_filename, file_md5):
+    """source_path为已保存的临时文件，入库后移动到上传目录；返回 (结果, 状态码)"""
     # 检查数据库中是否已存在相同MD5的图片
     conn = get_db_connection()
 
@@ -344,53 +765,148 @@ def upload_image(album_id):
         JOIN albums a ON i.album_id = a.id 
         WHERE i.file_hash = ?
     ''', (file_md5,)).fetchone()
+    conn.close()
 
     if existing_image:
-        conn.close()
-        return jsonify({
+        os.remove(source_path)
+        return {
             'error': f'图片已存在于相册 "{existing_image["album_name"]}" 中',
             'existing_filename': existing_image['original_filename'],
             'album_name': existing_image['album_name']
-        }), 409  # 409 Conflict
+        }, 409  # 409 Conflict
 
     # 生成唯一文件名
-    filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{file.filename}"
+    filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{original_filename}"
 
-    original_path = os.path.join(UPLOAD_FOLDER, filename)
-    thumb_path = os.path.join(THUMBNAIL_FOLDER, filename)
-    compressed_path = os.path.join(COMPRESSED_FOLDER, filename)
+    saved = False
+    try:
+        # 获取图片信息（只读取文件头，超过像素上限时Pillow会拒绝）
+        with Image.open(source_path) as img:
+            width, height = img.size
+            file_size = os.path.getsize(source_path)
 
-    # 保存原图
-    file.save(original_path)
+        # 生成缩略图和压缩图
+        generate_image_variant(filename, 'thumbnail', source_path)
+        generate_image_variant(filename, 'compressed', source_path)
+
+        # 保存原图
+        storage.put_file(UPLOAD_FOLDER, filename, source_path, mode='move')
+
+        # 保存到数据库
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO images (album_id, filename, original_filename, file_size, width, height, file_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (album_id, filename, original_filename, file_size, width, height, file_md5))
+        image_id = cursor.lastrowid
+        invalidate_home_payload(conn)
+        conn.commit()
+        conn.close()
+        saved = True
+    except (AdmissionRejected, Image.DecompressionBombError) as e:
+        # 图片本身过大返回413，处理繁忙返回503由客户端重试
+        status = 503 if getattr(e, 'retryable', False) else 413
+        return {'error': str(e)}, status
+    finally:
+        # 任何失败（包括无法识别的文件）都清理临时文件和已保存的文件
+        if os.path.exists(source_path):
+            os.remove(source_path)
+        if not saved:
+            delete_image_files(filename)
+
+    schedule_mosaic_refresh(album_id)
+
+    return {
+        'id': image_id,
+        'filename': filename,
+        'original_filename': original_filename,
+        'message': '图片上传成功'
+    }, 200
 
-    # 获取图片信息
-    with Image.open(original_path) as img:
-        width, height = img.size
-        file_size = os.path.getsize(original_path)
 
-    # 生成缩略图和压缩图
-    generate_thumbnail(original_path, thumb_path)
-    generate_compressed(original_path, compressed_path)
+# 创建分块上传会话
+@app.route('/api/albums/<int:album_id>/uploads', methods=['POST'])
+def create_chunked_upload(album_id):
+    data = request.get_json()
 
-    # 保存到数据库
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO images (album_id, filename, original_filename, file_size, width, height, file_hash)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (album_id, filename, file.filename, file_size, width, height, file_md5))
-    image_id = cursor.lastrowid
-    conn.commit()
+    album = conn.execute('SELECT id FROM albums WHERE id = ?', (album_id,)).fetchone()
     conn.close()
+    if not album:
+        return jsonify({'error': '相册不存在'}), 404
+
+    try:
+        session = create_upload_session(CHUNK_FOLDER, album_id, data.get('filename'), data.get('size'),
+                                        data.get('chunk_size'), data.get('md5'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     return jsonify({
-        'id': image_id,
-        'filename': filename,
-        'original_filename': file.filename,
-        'message': '图片上传成功'
+        'upload_id': session['upload_id'],
+        'chunk_size': session['chunk_size'],
+        'chunk_count': session['chunk_count']
     })
 
 
+# 查询分块上传进度，用于断点续传
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_chunked_upload(upload_id):
+    session = load_upload_session(CHUNK_FOLDER, upload_id)
+    if not session:
+        return jsonify({'error': '上传会话不存在或已过期'}), 404
+
+    return jsonify({**session, 'received': received_chunks(CHUNK_FOLDER, session)})
+
+
+# 上传单个分块，请求体为分块的原始数据
+@app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    session = load_upload_session(CHUNK_FOLDER, upload_id)
+    if not session:
+        return jsonify({'error': '上传会话不存在或已过期'}), 404
+
+    try:
+        size = write_chunk(CHUNK_FOLDER, session, index, request.stream, request.headers.get('Content-MD5'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({'index': index, 'size': size})
+
+
+# 合并分块并入库
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    session = load_upload_session(CHUNK_FOLDER, upload_id)
+    if not session:
+        return jsonify({'error': '上传会话不存在或已过期'}), 404
+
+    # 客户端重试时可能重复提交，同一会话只允许一个请求合并
+    if not claim_upload_session(CHUNK_FOLDER, session):
+        return jsonify({'error': '该上传正在合并或已完成'}), 409
+
+    temp_path = os.path.join(TEMP_FOLDER, f"{uuid.uuid4().hex}.part")
+    try:
+        file_md5 = assemble_upload(CHUNK_FOLDER, session, temp_path)
+    except ValueError as e:
+        release_upload_session(CHUNK_FOLDER, session)
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        release_upload_session(CHUNK_FOLDER, session)
+        return jsonify({'error': f'合并分块失败: {str(e)}'}), 500
+
+    delete_upload_session(CHUNK_FOLDER, upload_id)
+    result, status = ingest_image(session['album_id'], temp_path, session['filename'], file_md5)
+    return jsonify(result), status
+
+
+# 取消分块上传
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def cancel_chunked_upload(upload_id):
+    delete_upload_session(CHUNK_FOLDER, upload_id)
+    return jsonify({'message': '上传已取消'})
+
+
 @app.route('/api/images/<int:image_id>/rename', methods=['POST'])
 def rename_image(image_id):
     data = request.get_json()
@@ -478,22 +994,36 @@ def delete_image(image_id):
 
     if image:
         # 删除文件
-        original_path = os.path.join(UPLOAD_FOLDER, image['filename'])
-        thumb_path = os.path.join(THUMBNAIL_FOLDER, image['filename'])
-        compressed_path = os.path.join(COMPRESSED_FOLDER, image['filename'])
-
-        for path in [original_path, thumb_path, compressed_path]:
-            if os.path.exists(path):
-                os.remove(path)
+        delete_image_files(image['filename'])
 
         # 删除数据库记录
         conn.execute('DELETE FROM images WHERE id = ?', (image_id,))
+        invalidate_home_payload(conn)
         conn.commit()
+        schedule_mosaic_refresh(image['album_id'])
 
     conn.close()
     return jsonify({'message': '图片删除成功'})
 
 
+# 派生图缓存统计
+@app.route('/api/cache/stats')
+def get_cache_stats():
+    return jsonify(image_cache.stats())
+
+
+image_cache_gauge = Gauge('gallery_image_cache', '派生图内存缓存统计', ('stat',))
+
+
+# Prometheus指标
+@app.route('/metrics')
+def get_metrics():
+    for stat, value in image_cache.stats().items():
+        if not isinstance(value, bool):
+            image_cache_gauge.set(value, stat=stat)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
 # 验证相册密码API
 @app.route('/api/albums/<int:album_id>/verify-password', methods=['POST'])
 def verify_album_password(album_id):
@@ -571,8 +1101,10 @@ def set_album_password(album_id):
             (album_id, password)
         )
 
+    invalidate_home_payload(conn)
     conn.commit()
     conn.close()
+    schedule_mosaic_refresh(album_id)
 
     return jsonify({'message': '密码设置成功'})
 
@@ -590,8 +1122,10 @@ def remove_album_password(album_id):
 
     # 删除密码记录
     conn.execute('DELETE FROM album_passwords WHERE album_id = ?', (album_id,))
+    invalidate_home_payload(conn)
     conn.commit()
     conn.close()
+    schedule_mosaic_refresh(album_id)
 
     return jsonify({'message': '密码已移除'})
 
@@ -656,6 +1190,7 @@ def update_site_title():
             INSERT OR REPLACE INTO site_config (key, value) 
             VALUES (?, ?)
         ''', ('site_title', new_title))
+        invalidate_home_payload(conn)
 
         conn.commit()
         conn.close()
@@ -697,25 +1232,9 @@ def get_site_title():
 
 def add_md5_to_existing_images():
     """为已有图片计算并添加MD5值（一次性运行）"""
-    conn = get_db_connection()
-    images = conn.execute('SELECT id, filename FROM images WHERE file_hash IS NULL').fetchall()
-
-    for image in images:
-        original_path = os.path.join(UPLOAD_FOLDER, image['filename'])
-        if os.path.exists(original_path):
-            try:
-                with open(original_path, 'rb') as f:
-                    file_content = f.read()
-                    md5_hash = hashlib.md5(file_content).hexdigest()
-
-                conn.execute('UPDATE images SET file_hash = ? WHERE id = ?',
-                             (md5_hash, image['id']))
-                print(f"Updated MD5 for image {image['id']}")
-            except Exception as e:
-                print(f"Error processing image {image['id']}: {e}")
+    from maintenance import HashBackfillTask, run_task
 
-    conn.commit()
-    conn.close()
+    run_task(HashBackfillTask())
     print("MD5 migration completed")
 
 
@@ -762,8 +1281,10 @@ def move_images():
             conn.execute('UPDATE images SET album_id = ? WHERE id = ?', (target_album_id, image['id']))
             moved_count += 1
 
+        invalidate_home_payload(conn)
         conn.commit()
         conn.close()
+        schedule_mosaic_refresh(target_album_id, *{image['album_id'] for image in existing_images})
 
         return jsonify({
             'message': f'成功移动 {moved_count} 张图片',
@@ -776,6 +1297,105 @@ def move_images():
         return jsonify({'error': f'移动图片失败: {str(e)}'}), 500
 
 
+# 加密相册的图片需要对应相册的token（浏览器直接下载无法带请求头，也可以通过token参数传递）
+def zip_download_allowed(images, auth_token):
+    for album_id in {image['album_id'] for image in images if image['password_id']}:
+        if not auth_token or not verify_auth_token(auth_token, album_id):
+            return False
+    return True
+
+
+# 压缩包条目，边输出边查询文件大小，原图缺失的跳过
+def zip_entries(images):
+    for image in images:
+        try:
+            file_size = storage.size(UPLOAD_FOLDER, image['filename'])
+        except FileNotFoundError:
+            continue
+        yield (image['original_filename'], file_size,
+               functools.partial(storage.open, UPLOAD_FOLDER, image['filename']))
+
+
+def zip_content_disposition(download_name):
+    return f"attachment; filename*=UTF-8''{quote(download_name)}"
+
+
+# 以ZIP流的方式下载原图
+def zip_download_response(images, download_name):
+    auth_token = request.headers.get('X-Album-Auth') or request.args.get('token')
+    if not zip_download_allowed(images, auth_token):
+        return jsonify({'error': '无权访问此加密相册'}), 403
+
+    response = Response(stream_with_context(stream_zip(zip_entries(images))), mimetype='application/zip')
+    response.headers['Content-Disposition'] = zip_content_disposition(download_name)
+    return response
+
+
+# 查询相册及其全部图片，相册不存在时返回 (None, [])
+def find_album_download(album_id):
+    conn = get_db_connection()
+    album = conn.execute('SELECT * FROM albums WHERE id = ?', (album_id,)).fetchone()
+    if not album:
+        conn.close()
+        return None, []
+
+    images = conn.execute('''
+        SELECT i.*, ap.id as password_id
+        FROM images i
+        LEFT JOIN album_passwords ap ON i.album_id = ap.album_id
+        WHERE i.album_id = ?
+        ORDER BY i.uploaded_at DESC
+    ''', (album_id,)).fetchall()
+    conn.close()
+    return album, images
+
+
+# 按id查询要下载的图片
+def find_download_images(image_ids):
+    conn = get_db_connection()
+    placeholders = ','.join(['?'] * len(image_ids))
+    images = conn.execute(f'''
+        SELECT i.*, ap.id as password_id
+        FROM images i
+        LEFT JOIN album_passwords ap ON i.album_id = ap.album_id
+        WHERE i.id IN ({placeholders})
+    ''', image_ids).fetchall()
+    conn.close()
+    return images
+
+
+def zip_download_name():
+    return f"images_{datetime.now().strftime('%Y%m%d%H%M%S')}.zip"
+
+
+# 下载整个相册
+@app.route('/api/albums/<int:album_id>/download')
+def download_album(album_id):
+    album, images = find_album_download(album_id)
+    if not album:
+        return jsonify({'error': '相册不存在'}), 404
+
+    return zip_download_response(images, f"{album['name']}.zip")
+
+
+# 下载选中的图片，ids为逗号分隔的图片id
+@app.route('/api/images/download')
+def download_images():
+    try:
+        image_ids = [int(i) for i in request.args.get('ids', '').split(',') if i]
+    except ValueError:
+        return jsonify({'error': '图片id无效'}), 400
+
+    if not image_ids:
+        return jsonify({'error': '请选择要下载的图片'}), 400
+
+    images = find_download_images(image_ids)
+    if len(images) != len(set(image_ids)):
+        return jsonify({'error': '部分图片不存在'}), 404
+
+    return zip_download_response(images, zip_download_name())
+
+
 if __name__ == '__main__':
     init_db()
     # add_md5_to_existing_images()
@@ -0,0 +1,282 @@
+"""图库维护任务
+
+按id分块遍历images表，在进程池中并行处理，每处理完一块提交一次事务并记录检查点，
+中断后重新运行会从检查点继续。
+
+用法:
+    python maintenance.py hash                 # 补全缺失的MD5
+    python maintenance.py dimensions           # 修复尺寸和文件大小
+    python maintenance.py derivatives --all    # 重新生成缩略图和压缩图
+    python maintenance.py audit --report missing.jsonl
+    python maintenance.py mosaics              # 生成缺失或过期的相册拼图
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+# 读取图片尺寸时下载的文件头大小（JPEG的EXIF等数据段位于尺寸信息之前）
+HEADER_READ_BYTES = 256 * 1024
+
+
+class MaintenanceTask(ABC):
+    """维护任务基类：select_sql选出待处理的行，process在工作进程中执行，apply在主进程中写回结果
+
+    文件通过main.storage访问，本地目录和对象存储都适用。
+    """
+
+    name = ''
+    # 必须包含 id > ? 条件，并按id排序
+    select_sql = 'SELECT id, filename FROM images WHERE id > ? ORDER BY id LIMIT ?'
+    count_sql = 'SELECT COUNT(*) FROM images'
+
+    @abstractmethod
+    def process(self, row):
+        """在工作进程中处理一行，返回值传给apply"""
+
+    def apply(self, conn, row, result):
+        pass
+
+    def finish(self):
+        pass
+
+
+class HashBackfillTask(MaintenanceTask):
+    """为缺少file_hash的图片分块读取原图计算MD5"""
+
+    name = 'hash'
+    select_sql = 'SELECT id, filename FROM images WHERE file_hash IS NULL AND id > ? ORDER BY id LIMIT ?'
+    count_sql = 'SELECT COUNT(*) FROM images WHERE file_hash IS NULL'
+
+    def process(self, row):
+        import main
+
+        if not main.storage.exists(main.UPLOAD_FOLDER, row['filename']):
+            return None
+        md5 = hashlib.md5()
+        for chunk in main.storage.stream(main.UPLOAD_FOLDER, row['filename']):
+            md5.update(chunk)
+        return md5.hexdigest()
+
+    def apply(self, conn, row, result):
+        if result:
+            conn.execute('UPDATE images SET file_hash = ? WHERE id = ?', (result, row['id']))
+
+
+class DimensionRepairTask(MaintenanceTask):
+    """根据原图修复宽高和文件大小"""
+
+    name = 'dimensions'
+    select_sql = 'SELECT id, filename, width, height, file_size FROM images WHERE id > ? ORDER BY id LIMIT ?'
+
+    def process(self, row):
+        import main
+
+        try:
+            file_size = main.storage.size(main.UPLOAD_FOLDER, row['filename'])
+        except FileNotFoundError:
+            return None
+        # 只读取文件开头解析尺寸，不下载整个原图；文件头超出范围时再取本地副本
+        head = main.storage.read_head(main.UPLOAD_FOLDER, row['filename'], HEADER_READ_BYTES)
+        try:
+            with Image.open(io.BytesIO(head)) as img:
+                width, height = img.size
+        except (OSError, SyntaxError):
+            with main.storage.local_copy(main.UPLOAD_FOLDER, row['filename']) as original_path, \
+                    Image.open(original_path) as img:
+                width, height = img.size
+        return width, height, file_size
+
+    def apply(self, conn, row, result):
+        if result and result != (row['width'], row['height'], row['file_size']):
+            conn.execute('UPDATE images SET width = ?, height = ?, file_size = ? WHERE id = ?',
+                         (*result, row['id']))
+
+
+class DerivativeRegenerateTask(MaintenanceTask):
+    """重新生成缩略图和压缩图（默认只生成缺失的）"""
+
+    name = 'derivatives'
+
+    def __init__(self, regenerate_all=False):
+        self.regenerate_all = regenerate_all
+
+    def process(self, row):
+        import main
+
+        filename = row['filename']
+        if not main.storage.exists(main.UPLOAD_FOLDER, filename):
+            return None
+
+        missing = [variant for variant in ('thumbnail', 'compressed')
+                   if self.regenerate_all or not main.storage.exists(main.VARIANT_FOLDERS[variant], filename)]
+        if not missing:
+            return []
+
+        # 原图只取一次本地副本（对象存储时下载到临时文件）
+        with main.storage.local_copy(main.UPLOAD_FOLDER, filename) as original_path:
+            for variant in missing:
+                main.generate_image_variant(filename, variant, original_path)
+        return missing
+
+    def apply(self, conn, row, result):
+        if result:
+            # 通过共享缓存段通知运行中的服务（需要与服务使用相同的IMAGE_CACHE_SHARED_PATH，默认tmp/image_cache.bin）
+            import main
+            main.invalidate_image_cache(row['filename'])
+
+
+class MissingFileAuditTask(MaintenanceTask):
+    """检查原图、缩略图和压缩图是否缺失，结果写入报告文件"""
+
+    name = 'audit'
+
+    def __init__(self, report_path=None):
+        self.report_path = report_path
+        self.missing_count = 0
+        self._report = None
+
+    def __getstate__(self):
+        # 报告文件只在主进程中使用，不传给工作进程
+        state = self.__dict__.copy()
+        state['_report'] = None
+        return state
+
+    def process(self, row):
+        import main
+
+        return [variant for variant, folder in main.VARIANT_FOLDERS.items()
+                if not main.storage.exists(folder, row['filename'])]
+
+    def apply(self, conn, row, result):
+        if not result:
+            return
+        self.missing_count += 1
+        line = json.dumps({'id': row['id'], 'filename': row['filename'], 'missing': result}, ensure_ascii=False)
+        if self.report_path:
+            if self._report is None:
+                self._report = open(self.report_path, 'a', encoding='utf-8')
+            self._report.write(line + '\n')
+        else:
+            print(line)
+
+    def finish(self):
+        if self._report:
+            self._report.close()
+        print(f'缺失文件的图片: {self.missing_count}')
+
+
+class MosaicRefreshTask(MaintenanceTask):
+    """为已有图库生成相册拼图，签名未变化的相册直接跳过"""
+
+    name = 'mosaics'
+    select_sql = 'SELECT id FROM albums WHERE id > ? ORDER BY id LIMIT ?'
+    count_sql = 'SELECT COUNT(*) FROM albums'
+
+    def process(self, row):
+        import main
+
+        # 拼图记录在工作进程中写入，写入前会再次确认相册内容
+        return main.refresh_album_mosaic(row['id'])
+
+
+def init_checkpoint_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_checkpoints (
+            task TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+
+def run_task(task, workers=None, chunk_size=500, restart=False):
+    """分块执行维护任务，每块提交一次并更新检查点"""
+    import main
+
+    conn = main.get_db_connection()
+    init_checkpoint_table(conn)
+
+    last_id = 0
+    if restart:
+        conn.execute('DELETE FROM maintenance_checkpoints WHERE task = ?', (task.name,))
+        conn.commit()
+    else:
+        checkpoint = conn.execute('SELECT last_id FROM maintenance_checkpoints WHERE task = ?',
+                                  (task.name,)).fetchone()
+        if checkpoint:
+            last_id = checkpoint['last_id']
+            print(f'从检查点继续: id > {last_id}')
+
+    total = conn.execute(task.count_sql).fetchone()[0]
+    processed = 0
+    failed = 0
+    start = time.time()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            rows = [dict(row) for row in conn.execute(task.select_sql, (last_id, chunk_size)).fetchall()]
+            if not rows:
+                break
+
+            futures = [executor.submit(task.process, row) for row in rows]
+            for row, future in zip(rows, futures):
+                try:
+                    task.apply(conn, row, future.result())
+                except Exception as e:
+                    failed += 1
+                    print(f"处理图片 {row['id']} 失败: {e}")
+
+            last_id = rows[-1]['id']
+            conn.execute('INSERT OR REPLACE INTO maintenance_checkpoints (task, last_id) VALUES (?, ?)',
+                         (task.name, last_id))
+            conn.commit()
+
+            processed += len(rows)
+            elapsed = time.time() - start
+            print(f'[{task.name}] {processed}/{total}，失败 {failed}，{processed / elapsed:.1f} 张/秒')
+
+    # 全部完成后清除检查点，下次运行从头开始
+    conn.execute('DELETE FROM maintenance_checkpoints WHERE task = ?', (task.name,))
+    conn.commit()
+    conn.close()
+    task.finish()
+    print(f'[{task.name}] 完成')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='图库维护任务')
+    parser.add_argument('task', choices=['hash', 'dimensions', 'derivatives', 'audit', 'mosaics'])
+    parser.add_argument('--root', default='.', help='图库目录（gallery.db所在目录）')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=500, help='每次提交处理的图片数')
+    parser.add_argument('--restart', action='store_true', help='忽略检查点从头开始')
+    parser.add_argument('--all', action='store_true', help='derivatives: 重新生成全部派生图')
+    parser.add_argument('--report', help='audit: 报告文件（JSON Lines）')
+    args = parser.parse_args()
+
+    os.chdir(args.root)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    main.init_db()
+    if args.task == 'hash':
+        task = HashBackfillTask()
+    elif args.task == 'dimensions':
+        task = DimensionRepairTask()
+    elif args.task == 'derivatives':
+        task = DerivativeRegenerateTask(regenerate_all=args.all)
+    elif args.task == 'mosaics':
+        task = MosaicRefreshTask()
+    else:
+        task = MissingFileAuditTask(args.report)
+
+    run_task(task, args.workers, args.chunk_size, args.restart)
@@ -0,0 +1,227 @@
+"""运行指标：Prometheus文本格式的计数器、仪表和直方图
+
+指标保存在当前进程内，多worker部署时每个进程分别暴露自己的/metrics。
+"""
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# 超过该耗时（毫秒）的请求记录各阶段耗时
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 1000))
+
+slow_logger = logging.getLogger('gallery.slow_request')
+
+_registry = []
+
+# 当前请求中各阶段的耗时记录 [(stage, seconds), ...]
+_request_stages = ContextVar('request_stages', default=None)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}']
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def _render_value(self, key, state):
+        lines = []
+        for bound, count in zip(self.buckets, state['counts']):
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, ("le", bound))} {count}')
+        lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, ("le", "+Inf"))} {state["count"]}')
+        lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {state["sum"]}')
+        lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {state["count"]}')
+        return lines
+
+
+request_latency = Histogram('gallery_request_duration_seconds', '接口请求耗时', ('method', 'route', 'status'))
+stage_latency = Histogram('gallery_stage_duration_seconds', '各处理阶段耗时', ('stage',))
+derivative_regenerations = Counter('gallery_derivative_regenerations_total', '派生图重新生成次数', ('variant',))
+requests_in_flight = Gauge('gallery_requests_in_flight', '正在处理的请求数')
+queue_depth = Gauge('gallery_queue_depth', '各执行队列中等待或执行中的任务数', ('queue',))
+
+
+def render_metrics():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def timed(stage):
+    """记录一个处理阶段的耗时，同时计入当前请求的阶段明细"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_latency.observe(elapsed, stage=stage)
+        stages = _request_stages.get()
+        if stages is not None:
+            stages.append((stage, elapsed))
+
+
+def timed_stage(stage):
+    """timed的装饰器形式"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def begin_request():
+    requests_in_flight.inc()
+    _request_stages.set([])
+    return time.perf_counter()
+
+
+def end_request(start, method, route, status):
+    """记录请求耗时，超过阈值时输出各阶段耗时明细"""
+    elapsed = time.perf_counter() - start
+    requests_in_flight.dec()
+    request_latency.observe(elapsed, method=method, route=route, status=status)
+
+    stages = _request_stages.get() or []
+    _request_stages.set(None)
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        breakdown = {}
+        for stage, seconds in stages:
+            total, count = breakdown.get(stage, (0.0, 0))
+            breakdown[stage] = (total + seconds, count + 1)
+        detail = ', '.join(f'{stage}={total * 1000:.1f}ms/{count}' for stage, (total, count) in breakdown.items())
+        slow_logger.warning('慢请求 %s %s %s %.1fms [%s]', method, route, status, elapsed * 1000, detail)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """记录SQL执行耗时的游标
+
+    sqlite3在取结果时才逐行执行查询，大结果集的主要耗时在fetch阶段，单独记为db_fetch。
+    """
+
+    # 遍历游标时每次取出的行数
+    ITER_BATCH_SIZE = 256
+
+    def execute(self, *args, **kwargs):
+        with timed('db_query'):
+            return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        with timed('db_query'):
+            return super().executemany(*args, **kwargs)
+
+    def fetchone(self):
+        with timed('db_fetch'):
+            return super().fetchone()
+
+    def fetchmany(self, *args, **kwargs):
+        with timed('db_fetch'):
+            return super().fetchmany(*args, **kwargs)
+
+    def fetchall(self):
+        with timed('db_fetch'):
+            return super().fetchall()
+
+    def __iter__(self):
+        # 按批取行，避免逐行记录耗时
+        while True:
+            rows = self.fetchmany(self.ITER_BATCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+
+class TimedConnection(sqlite3.Connection):
+    """记录SQL执行耗时的数据库连接，用作sqlite3.connect的factory"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args, **kwargs):
+        return self.cursor().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self.cursor().executemany(*args, **kwargs)
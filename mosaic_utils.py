@@ -0,0 +1,62 @@
+"""相册封面拼图
+
+用相册中排在最前面的N张图片拼成一张方形封面。拼图的签名由参与拼图的文件名和布局参数计算，
+相册内容变化后只有签名改变的相册需要重新生成，签名不变时直接复用已保存的拼图。
+"""
+import hashlib
+import json
+import math
+import os
+
+from PIL import Image, ImageOps
+
+from admission_utils import decode_admission, estimate_decode_bytes, reduce_decode_size
+from metrics_utils import timed_stage
+
+# 参与拼图的图片数量
+MOSAIC_IMAGE_COUNT = int(os.getenv('MOSAIC_IMAGE_COUNT', 4))
+# 拼图边长（像素）
+MOSAIC_SIZE = int(os.getenv('MOSAIC_SIZE', 500))
+# 图片之间的间隔
+MOSAIC_GAP = 2
+
+
+def mosaic_signature(filenames, size=MOSAIC_SIZE):
+    """参与拼图的图片或布局参数变化时签名随之变化"""
+    data = json.dumps([size, MOSAIC_GAP, list(filenames)], ensure_ascii=False)
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
+def mosaic_layout(count, size=MOSAIC_SIZE):
+    """返回每张图片的区域 (left, top, right, bottom)，最后一行不满时拉宽填满"""
+    if count <= 0:
+        return []
+    if count == 3:
+        # 左侧一张大图，右侧上下两张
+        half = size // 2
+        return [(0, 0, half, size), (half, 0, size, half), (half, half, size, size)]
+
+    columns = math.ceil(math.sqrt(count))
+    rows = math.ceil(count / columns)
+    boxes = []
+    for row in range(rows):
+        in_row = min(columns, count - row * columns)
+        top, bottom = row * size // rows, (row + 1) * size // rows
+        for column in range(in_row):
+            boxes.append((column * size // in_row, top, (column + 1) * size // in_row, bottom))
+    return boxes
+
+
+@timed_stage('mosaic')
+def build_mosaic(image_paths, output_path, size=MOSAIC_SIZE):
+    """image_paths为本地图片路径（通常是压缩图），按顺序填入拼图"""
+    canvas = Image.new('RGB', (size, size), (255, 255, 255))
+    for image_path, (left, top, right, bottom) in zip(image_paths, mosaic_layout(len(image_paths), size)):
+        cell = (right - left - MOSAIC_GAP, bottom - top - MOSAIC_GAP)
+        with Image.open(image_path) as img:
+            # 只按格子大小解码
+            reduce_decode_size(img, cell)
+            with decode_admission.admit(estimate_decode_bytes(img)):
+                tile = ImageOps.fit(img.convert('RGB'), cell, Image.Resampling.LANCZOS)
+        canvas.paste(tile, (left + MOSAIC_GAP // 2, top + MOSAIC_GAP // 2))
+    canvas.save(output_path, 'JPEG', quality=85)
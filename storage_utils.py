@@ -0,0 +1,184 @@
+"""存储后端
+
+文件按 (目录, 文件名) 存取，目录为 uploads、thumbnails、compressed 等。
+LocalStorage 使用本地文件系统；S3Storage 使用S3兼容的对象存储（AWS S3、MinIO等），
+多个应用节点共享同一个存储桶即可共享图库。
+
+通过环境变量选择后端:
+    STORAGE_BACKEND=s3 S3_BUCKET=gallery S3_ENDPOINT_URL=http://127.0.0.1:9000
+"""
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+
+class LocalStorage:
+    is_local = True
+
+    def __init__(self, root='.'):
+        self.root = root
+
+    def path(self, folder, filename):
+        return os.path.join(self.root, folder, filename)
+
+    def put_file(self, folder, filename, local_path, mode='copy'):
+        """保存本地文件，mode为copy、move或hardlink"""
+        target = self.path(folder, filename)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if mode == 'move':
+            shutil.move(local_path, target)
+        elif mode == 'hardlink':
+            os.link(local_path, target)
+        else:
+            shutil.copy2(local_path, target)
+
+    def put_stream(self, folder, filename, stream, chunk_size=1024 * 1024):
+        """从文件对象流式写入，先写临时文件再重命名"""
+        target = self.path(folder, filename)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(stream, f, chunk_size)
+            os.replace(temp_path, target)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def open(self, folder, filename):
+        return open(self.path(folder, filename), 'rb')
+
+    def read_head(self, folder, filename, length):
+        """读取文件开头的length字节（用于读取图片文件头）"""
+        with self.open(folder, filename) as f:
+            return f.read(length)
+
+    def stream(self, folder, filename, chunk_size=1024 * 1024):
+        with self.open(folder, filename) as f:
+            yield from iter(lambda: f.read(chunk_size), b'')
+
+    def exists(self, folder, filename):
+        return os.path.exists(self.path(folder, filename))
+
+    def size(self, folder, filename):
+        return os.path.getsize(self.path(folder, filename))
+
+    def delete(self, folder, filename):
+        path = self.path(folder, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def presigned_url(self, folder, filename, expires_in=3600):
+        # 本地存储由应用自己下发文件
+        return None
+
+    @contextmanager
+    def local_copy(self, folder, filename):
+        """返回可供Pillow/exiftool使用的本地路径"""
+        yield self.path(folder, filename)
+
+
+class S3Storage:
+    is_local = False
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, max_pool_connections=50,
+                 multipart_chunk_mb=8):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        self.bucket = bucket
+        self.prefix = prefix
+        # 客户端线程安全，所有请求共用一个连接池
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region,
+            config=Config(max_pool_connections=max_pool_connections, retries={'max_attempts': 5, 'mode': 'standard'}),
+        )
+        # 超过分块大小的文件使用分块并行上传
+        chunk_size = multipart_chunk_mb * 1024 * 1024
+        self.transfer_config = TransferConfig(multipart_threshold=chunk_size, multipart_chunksize=chunk_size,
+                                              max_concurrency=8)
+
+    def key(self, folder, filename):
+        return f'{self.prefix}{folder}/{filename}'
+
+    def put_file(self, folder, filename, local_path, mode='copy'):
+        self.client.upload_file(local_path, self.bucket, self.key(folder, filename), Config=self.transfer_config)
+        if mode == 'move':
+            os.remove(local_path)
+
+    def put_stream(self, folder, filename, stream, chunk_size=None):
+        self.client.upload_fileobj(stream, self.bucket, self.key(folder, filename), Config=self.transfer_config)
+
+    def open(self, folder, filename):
+        return self.client.get_object(Bucket=self.bucket, Key=self.key(folder, filename))['Body']
+
+    def read_head(self, folder, filename, length):
+        # 使用Range请求，只下载文件开头
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key(folder, filename),
+                                          Range=f'bytes=0-{length - 1}')
+        return response['Body'].read()
+
+    def stream(self, folder, filename, chunk_size=1024 * 1024):
+        body = self.open(folder, filename)
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+
+    def _head(self, folder, filename):
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(folder, filename))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, folder, filename):
+        return self._head(folder, filename) is not None
+
+    def size(self, folder, filename):
+        head = self._head(folder, filename)
+        if head is None:
+            raise FileNotFoundError(self.key(folder, filename))
+        return head['ContentLength']
+
+    def delete(self, folder, filename):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(folder, filename))
+
+    def presigned_url(self, folder, filename, expires_in=3600):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.key(folder, filename)}, ExpiresIn=expires_in
+        )
+
+    @contextmanager
+    def local_copy(self, folder, filename):
+        """下载到临时文件，退出时删除"""
+        suffix = os.path.splitext(filename)[1]
+        fd, temp_path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, self.key(folder, filename), temp_path, Config=self.transfer_config)
+            yield temp_path
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def create_storage():
+    """根据环境变量创建存储后端"""
+    if os.getenv('STORAGE_BACKEND', 'local').lower() == 's3':
+        return S3Storage(
+            bucket=os.environ['S3_BUCKET'],
+            prefix=os.getenv('S3_PREFIX', ''),
+            endpoint_url=os.getenv('S3_ENDPOINT_URL'),
+            region=os.getenv('S3_REGION'),
+            max_pool_connections=int(os.getenv('S3_MAX_POOL_CONNECTIONS', 50)),
+            multipart_chunk_mb=int(os.getenv('S3_MULTIPART_CHUNK_MB', 8)),
+        )
+    return LocalStorage()
@@ -0,0 +1,184 @@
+"""分块断点续传
+
+上传会话和分块保存在磁盘上，每个分块单独写入，可以并行上传、失败后只重传缺失的分块。
+全部分块到齐后按顺序合并，同时计算MD5并与客户端声明的值校验，然后交给正常的入库流程。
+"""
+import base64
+import binascii
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+from metrics_utils import timed
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+# 未完成的上传会话保留时间（秒）
+UPLOAD_SESSION_EXPIRE_SECONDS = int(os.getenv('UPLOAD_SESSION_EXPIRE_SECONDS', 24 * 60 * 60))
+
+_UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _session_dir(base_folder, upload_id):
+    # upload_id来自URL，校验格式防止路径穿越
+    if not _UPLOAD_ID_PATTERN.match(upload_id or ''):
+        return None
+    return os.path.join(base_folder, upload_id)
+
+
+def load_upload_session(base_folder, upload_id):
+    """读取上传会话信息，不存在返回None"""
+    session_dir = _session_dir(base_folder, upload_id)
+    if not session_dir or not os.path.exists(os.path.join(session_dir, 'meta.json')):
+        return None
+    with open(os.path.join(session_dir, 'meta.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def create_upload_session(base_folder, album_id, filename, total_size, chunk_size=None, file_md5=None):
+    if not filename:
+        raise ValueError('文件名不能为空')
+    if not isinstance(total_size, int) or total_size <= 0:
+        raise ValueError('文件大小无效')
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    if not isinstance(chunk_size, int) or not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError('分块大小无效')
+
+    cleanup_expired_uploads(base_folder)
+
+    upload_id = uuid.uuid4().hex
+    session = {
+        'upload_id': upload_id,
+        'album_id': album_id,
+        'filename': os.path.basename(filename),
+        'size': total_size,
+        'chunk_size': chunk_size,
+        'chunk_count': (total_size + chunk_size - 1) // chunk_size,
+        'md5': file_md5.lower() if file_md5 else None,
+        'created_at': time.time(),
+    }
+    session_dir = _session_dir(base_folder, upload_id)
+    os.makedirs(session_dir)
+    with open(os.path.join(session_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(session, f, ensure_ascii=False)
+    return session
+
+
+def received_chunks(base_folder, session):
+    session_dir = _session_dir(base_folder, session['upload_id'])
+    return sorted(int(name[:-5]) for name in os.listdir(session_dir) if name.endswith('.part'))
+
+
+def write_chunk(base_folder, session, index, stream, content_md5=None):
+    """从请求流写入一个分块，先写临时文件再重命名，中途断开不会留下不完整的分块
+
+    content_md5为Content-MD5请求头（分块MD5的base64），提供时校验分块内容。
+    """
+    if not 0 <= index < session['chunk_count']:
+        raise ValueError('分块序号无效')
+
+    expected_md5 = None
+    if content_md5:
+        try:
+            expected_md5 = base64.b64decode(content_md5, validate=True).hex()
+        except (binascii.Error, ValueError):
+            raise ValueError('Content-MD5格式无效')
+
+    expected_size = min(session['chunk_size'], session['size'] - index * session['chunk_size'])
+    session_dir = _session_dir(base_folder, session['upload_id'])
+    chunk_path = os.path.join(session_dir, f'{index}.part')
+    temp_path = os.path.join(session_dir, f'{index}.{uuid.uuid4().hex}.tmp')
+
+    written = 0
+    md5 = hashlib.md5()
+    try:
+        with timed('file_io'), open(temp_path, 'wb') as f:
+            while True:
+                data = stream.read(min(1024 * 1024, expected_size - written + 1))
+                if not data:
+                    break
+                written += len(data)
+                if written > expected_size:
+                    break
+                md5.update(data)
+                f.write(data)
+
+        if written != expected_size:
+            raise ValueError(f'分块大小不正确，应为 {expected_size} 字节')
+        if expected_md5 and md5.hexdigest() != expected_md5:
+            raise ValueError('分块校验失败，MD5不一致')
+        os.replace(temp_path, chunk_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return expected_size
+
+
+def claim_upload_session(base_folder, session):
+    """标记会话正在合并，重复提交时只有一个请求能取得，返回是否取得"""
+    session_dir = _session_dir(base_folder, session['upload_id'])
+    try:
+        os.close(os.open(os.path.join(session_dir, 'assembling'), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except (FileExistsError, FileNotFoundError):
+        # 已被其他请求取得，或会话已合并完成被删除
+        return False
+
+
+def release_upload_session(base_folder, session):
+    """合并失败时释放会话，补传分块后可以重新合并"""
+    session_dir = _session_dir(base_folder, session['upload_id'])
+    try:
+        os.remove(os.path.join(session_dir, 'assembling'))
+    except FileNotFoundError:
+        pass
+
+
+def assemble_upload(base_folder, session, output_path):
+    """按顺序合并分块并计算MD5，返回MD5；分块不完整或校验失败时抛出ValueError
+
+    调用前需要用claim_upload_session取得会话，失败时不保留output_path。
+    """
+    missing = set(range(session['chunk_count'])) - set(received_chunks(base_folder, session))
+    if missing:
+        raise ValueError(f'还有 {len(missing)} 个分块未上传')
+
+    session_dir = _session_dir(base_folder, session['upload_id'])
+    md5 = hashlib.md5()
+    try:
+        with timed('file_io'), open(output_path, 'wb') as output:
+            for index in range(session['chunk_count']):
+                with open(os.path.join(session_dir, f'{index}.part'), 'rb') as chunk:
+                    for data in iter(lambda: chunk.read(1024 * 1024), b''):
+                        md5.update(data)
+                        output.write(data)
+
+        file_md5 = md5.hexdigest()
+        if session['md5'] and session['md5'] != file_md5:
+            raise ValueError('文件校验失败，MD5不一致')
+    except BaseException:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    return file_md5
+
+
+def delete_upload_session(base_folder, upload_id):
+    session_dir = _session_dir(base_folder, upload_id)
+    if session_dir and os.path.exists(session_dir):
+        shutil.rmtree(session_dir, ignore_errors=True)
+
+
+def cleanup_expired_uploads(base_folder):
+    """清理过期未完成的上传会话"""
+    if not os.path.exists(base_folder):
+        return
+    deadline = time.time() - UPLOAD_SESSION_EXPIRE_SECONDS
+    for upload_id in os.listdir(base_folder):
+        session_dir = _session_dir(base_folder, upload_id)
+        if session_dir and os.path.getmtime(session_dir) < deadline:
+            shutil.rmtree(session_dir, ignore_errors=True)
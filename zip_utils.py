@@ -0,0 +1,75 @@
+"""流式生成ZIP压缩包
+
+边读文件边输出ZIP数据（本地文件或对象存储），不使用临时文件，内存占用与压缩包大小无关。
+已压缩的图片格式直接存储（ZIP_STORED），大文件和大量条目自动使用ZIP64。
+"""
+import os
+import time
+import zipfile
+
+# 已经压缩过的格式，再压缩没有收益
+STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif', '.avif'}
+
+
+class _StreamBuffer:
+    """只写缓冲区，zipfile写入的数据在每次输出时取走"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def safe_arcname(name):
+    """只保留文件名部分，防止解压时写到目标目录之外（zip slip）"""
+    name = os.path.basename(name.replace('\\', '/')).lstrip('.').replace(':', '_')
+    return name or 'image'
+
+
+def unique_arcname(name, used):
+    """同名文件追加序号，避免压缩包中出现重复条目"""
+    base, ext = os.path.splitext(name)
+    arcname = name
+    index = 1
+    while arcname in used:
+        arcname = f'{base} ({index}){ext}'
+        index += 1
+    used.add(arcname)
+    return arcname
+
+
+def stream_zip(entries, chunk_size=1024 * 1024):
+    """entries为 (压缩包内文件名, 文件大小, 打开文件的函数) 的可迭代对象，生成ZIP数据块"""
+    buffer = _StreamBuffer()
+    used = set()
+
+    # 输出流不可seek，zipfile会改用数据描述符记录CRC和大小
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as zf:
+        for arcname, file_size, opener in entries:
+            arcname = unique_arcname(safe_arcname(arcname), used)
+            zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+            # 预先给出文件大小，zipfile据此决定是否使用ZIP64
+            zinfo.file_size = file_size
+            zinfo.external_attr = 0o644 << 16
+            if os.path.splitext(arcname)[1].lower() in STORED_EXTENSIONS:
+                zinfo.compress_type = zipfile.ZIP_STORED
+            else:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+
+            with opener() as src, zf.open(zinfo, 'w') as dest:
+                for data in iter(lambda: src.read(chunk_size), b''):
+                    dest.write(data)
+                    yield buffer.drain()
+            yield buffer.drain()
+
+    yield buffer.drain()